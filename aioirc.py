@@ -0,0 +1,248 @@
+"""
+	asyncio engine for the irc library.
+
+	AsyncReactor replaces irc.client.Reactor through the reactor_class of
+	irc.client.SimpleIRCClient (and thus irc.bot.SingleServerIRCBot). Its
+	connections read with asyncio streams and write into the non-blocking,
+	buffered transport instead of calling socket.send() directly, and the
+	timers of execute_delayed() etc. are asyncio timers. Jobs put directly
+	on the reactor's scheduler (the bot's reconnect strategy, keepalive
+	pings) are run from a periodic loop timer. Everything else,
+	parsing lines, dispatching events to the handlers and the on_* methods
+	and tracking channels, is done by the irc library as before.
+
+	All AsyncReactors share one event loop, so several bots (server
+	connections) can run in one thread, see run(). Like irc.client.Reactor
+	the reactor's mutex is held while handlers and timers run, so other
+	threads can use the bot while holding it.
+"""
+
+import time
+import asyncio
+import functools
+import threading
+import traceback
+
+import irc.client
+from irc.client import Event, ServerNotConnectedError
+
+# disconnect if the server doesn't read what is sent to it
+MAX_WRITE_BUFFER = 4 * 1024 * 1024
+
+READ_SIZE = 2 ** 14
+
+# how often jobs on reactor.scheduler are run, like the select timeout of
+# irc.client.Reactor.process_forever()
+SCHEDULER_INTERVAL = 0.2
+
+_loop = None
+
+def get_loop():
+	"""
+		The event loop shared by all AsyncReactors.
+	"""
+	global _loop
+	if _loop is None:
+		_loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(_loop)
+	return _loop
+
+def run(bots):
+	"""
+		Connect the irc.bot.SingleServerIRCBot objects (with reactor_class
+		AsyncReactor) and run them in one event loop until stop() is
+		called on one of their reactors.
+	"""
+	for bot in bots:
+		bot._connect()
+	get_loop().run_forever()
+
+class AsyncReactor(irc.client.Reactor):
+	def __init__(self, *args, **kwargs):
+		irc.client.Reactor.__init__(self, *args, **kwargs)
+		self.loop = get_loop()
+		self.thread_id = None
+		self.loop.call_soon_threadsafe(self.run_scheduler)
+
+	def server(self):
+		connection = AsyncServerConnection(self)
+		with self.mutex:
+			self.connections.append(connection)
+		return connection
+
+	def process_once(self, timeout=0):
+		"""
+			Run the event loop for timeout seconds, at least one iteration,
+			like one select() of irc.client.Reactor. Must not be called from
+			a handler, the loop is already running then.
+		"""
+		self.loop.run_until_complete(asyncio.sleep(timeout))
+
+	def process_forever(self, timeout=0.2):
+		self.loop.run_forever()
+
+	def stop(self, message=''):
+		"""
+			Disconnect the connections of this reactor and stop the shared
+			event loop. Can be called from any thread and from signal handlers.
+		"""
+		self.loop.call_soon_threadsafe(self.run_locked, lambda: self.shutdown(message))
+
+	def shutdown(self, message):
+		self.disconnect_all(message)
+		self.loop.stop()
+
+	def run_scheduler(self):
+		"""
+			Run the due jobs of reactor.scheduler. irc.client.Reactor does
+			this in process_once(), but the irc library also schedules on it
+			directly, e.g. ExponentialBackoff's reconnects and
+			set_keepalive().
+		"""
+		self.loop.call_later(SCHEDULER_INTERVAL, self.run_scheduler)
+		with self.mutex:
+			try:
+				self.scheduler.run_pending()
+			except Exception:
+				traceback.print_exc()
+
+	def run_locked(self, function):
+		with self.mutex:
+			function()
+
+	def call_later(self, delay, function):
+		if threading.get_ident() == self.thread_id:
+			self.loop.call_later(delay, self.run_locked, function)
+		else:
+			# not thread-safe itself, the loop thread has to do it
+			self.loop.call_soon_threadsafe(self.loop.call_later, delay, self.run_locked, function)
+
+	def execute_at(self, at, function, arguments=()):
+		self.call_later(max(at - time.time(), 0), functools.partial(function, *arguments))
+
+	def execute_delayed(self, delay, function, arguments=()):
+		self.call_later(delay, functools.partial(function, *arguments))
+
+	def execute_every(self, period, function, arguments=()):
+		function = functools.partial(function, *arguments)
+
+		def run():
+			self.call_later(period, run)
+			function()
+
+		self.call_later(period, run)
+
+class AsyncServerConnection(irc.client.ServerConnection):
+	"""
+		irc.client.ServerConnection on asyncio streams. connect() returns
+		immediately, the connection is opened and read by a task. When
+		that fails a disconnect event is dispatched, so that the bot's
+		reconnect strategy applies.
+	"""
+
+	def __init__(self, reactor):
+		irc.client.ServerConnection.__init__(self, reactor)
+		self.socket = None
+		self.writer = None
+		self.task = None
+
+	def connect(self, server, port, nickname, password=None, username=None,
+	            ircname=None, connect_factory=None):
+		if self.connected or self.task is not None:
+			self.disconnect('Changing servers')
+
+		self.buffer = self.buffer_class()
+		self.handlers = {}
+		self.real_server_name = ''
+		self.real_nickname = nickname
+		self.server = server
+		self.port = port
+		self.server_address = (server, port)
+		self.nickname = nickname
+		self.username = username or nickname
+		self.ircname = ircname or nickname
+		self.password = password
+		self.task = self.reactor.loop.create_task(self.run())
+		return self
+
+	def reconnect(self):
+		self.connect(self.server, self.port, self.nickname, self.password, self.username, self.ircname)
+
+	async def run(self):
+		reactor = self.reactor
+		reactor.thread_id = threading.get_ident()
+		try:
+			reader, writer = await asyncio.open_connection(self.server, self.port)
+		except OSError as exc:
+			self.task = None
+			with reactor.mutex:
+				self._handle_event(Event('disconnect', self.server, '', ["Couldn't connect to socket: %s" % exc]))
+			return
+
+		with reactor.mutex:
+			self.writer = writer
+			self.socket = writer.get_extra_info('socket')
+			self.connected = True
+			reactor._on_connect(self.socket)
+			if self.password:
+				self.pass_(self.password)
+			self.nick(self.nickname)
+			self.user(self.username, self.ircname)
+
+		try:
+			while True:
+				data = await reader.read(READ_SIZE)
+				with reactor.mutex:
+					if not data:
+						break
+					self.buffer.feed(data)
+					for line in self.buffer:
+						if line:
+							self._process_line(line)
+		except OSError:
+			pass
+		except asyncio.CancelledError:
+			return
+		except Exception:
+			traceback.print_exc()
+
+		with reactor.mutex:
+			if self.task is not None and self.writer is writer:
+				self.task = None
+				self.disconnect('Connection reset by peer')
+
+	def send_bytes(self, data):
+		"""
+			Queue data to be sent. Never blocks, the transport writes it when
+			the socket is writable.
+		"""
+		writer = self.writer
+		if writer is None:
+			raise ServerNotConnectedError('Not connected.')
+		writer.write(data)
+		if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+			self.disconnect('Send buffer exceeded.')
+
+	def send_raw(self, string):
+		self.send_bytes(self._prep_message(string))
+
+	def disconnect(self, message=''):
+		task = self.task
+		self.task = None
+		if task is not None and not self.connected:
+			# still connecting
+			task.cancel()
+
+		if not self.connected:
+			return
+
+		self.connected = False
+		self.quit(message)
+
+		# the buffered data is still sent before the transport is closed
+		self.writer.close()
+		self.writer = None
+		self.socket = None
+		if task is not None:
+			task.cancel()
+		self._handle_event(Event('disconnect', self.server, '', [message]))
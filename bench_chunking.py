@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import sys
+import random
+from time import perf_counter
+
+from countbot import chunk_message
+
+def old_chunk_message(channel, message, maxlen):
+	"""
+		The chunking of chunked_privmsg before chunk_message: a byte by
+		byte search for the split point and the prefix encoded per call.
+		maxlen is the length of a chunk without the PRIVMSG prefix.
+	"""
+	channel_utf8 = channel.encode('utf-8')
+	message_utf8 = message.encode('utf-8')
+	N = len(message_utf8)
+	lines = []
+	if maxlen and N > maxlen:
+		index = 0
+		while index < N:
+			next_index = index + maxlen
+			if next_index >= N:
+				lines.append(b''.join((b'PRIVMSG ',channel_utf8,b' :',message_utf8[index:],b'\r\n')))
+				break
+
+			space_index = None
+			for i in range(next_index, index - 1, -1):
+				byte = message_utf8[i]
+				if byte == 32 or byte == 9:
+					space_index = i
+					break
+
+			if space_index is None:
+				while next_index > index:
+					byte = message_utf8[next_index]
+					if byte < 128 or byte >= 192:
+						break
+					next_index -= 1
+				chunk = message_utf8[index:next_index]
+			else:
+				chunk = message_utf8[index:space_index].rstrip()
+				next_index = space_index + 1
+
+			lines.append(b''.join((b'PRIVMSG ',channel_utf8,b' :',chunk,b'\r\n')))
+			index = next_index
+	else:
+		lines.append(b''.join((b'PRIVMSG ',channel_utf8,b' :',message_utf8,b'\r\n')))
+	return lines
+
+# CounterBot.privmsg_lines() caches the prefix per channel
+PREFIXES = {}
+
+def new_chunk_message(channel, message, maxlen):
+	prefix = PREFIXES.get(channel)
+	if prefix is None:
+		prefix = PREFIXES[channel] = b'PRIVMSG ' + channel.encode('utf-8') + b' :'
+	return chunk_message(prefix, message.encode('utf-8'), maxlen)
+
+def make_messages(count, words, seed):
+	rnd = random.Random(seed)
+	# like !count results: "word: 12, other: 3, ..." with some non-ASCII and
+	# some long words without spaces
+	vocabulary = ['word%d' % i for i in range(1000)] + ['äöü', '日本語', 'emote' * 40]
+	return [', '.join('%s: %d' % (rnd.choice(vocabulary), rnd.randint(1, 1000)) for _ in range(rnd.randint(1, words)))
+	        for _ in range(count)]
+
+def measure(chunk, channel, messages, maxlen, repeat):
+	best = None
+	for _ in range(repeat):
+		start = perf_counter()
+		for message in messages:
+			chunk(channel, message, maxlen)
+		elapsed = perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def main(args):
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Compare the speed of the message chunking implementations.')
+	parser.add_argument('--messages', type=int, default=10000)
+	parser.add_argument('--words', type=int, default=100, help='max. words per message')
+	parser.add_argument('--max-message-length', type=int, default=512, help='including "PRIVMSG #channel :" and CRLF')
+	parser.add_argument('--repeat', type=int, default=5)
+	parser.add_argument('--seed', type=int, default=0)
+	opts = parser.parse_args(args)
+
+	channel = '#channel'
+	maxlen = max(opts.max_message_length - len(channel) - 12, 8)
+	messages = make_messages(opts.messages, opts.words, opts.seed)
+	for message in messages:
+		if old_chunk_message(channel, message, maxlen) != new_chunk_message(channel, message, maxlen):
+			raise AssertionError('different chunks for %r' % message)
+
+	print('%d messages, %d bytes' % (len(messages), sum(len(message.encode('utf-8')) for message in messages)))
+	for name, chunk in (('old', old_chunk_message), ('new', new_chunk_message)):
+		elapsed = measure(chunk, channel, messages, maxlen, opts.repeat)
+		print('%-3s %8.1f ms %6.2f us/message' % (name, elapsed * 1000, elapsed * 1000000 / len(messages)))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
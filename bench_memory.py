@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import sys
+import random
+import tracemalloc
+
+from countbot import Counts, CompactCounts, DedupCounts, CompactDedupCounts, normalize
+
+class TupleList(list):
+	"""
+		The storage layout before Counts: one (user, word, timestamp) tuple per row.
+	"""
+	def add(self, user, word, timestamp):
+		self.append((user, word, timestamp))
+
+def make_rows(rows, users, vocabulary, seed):
+	rnd = random.Random(seed)
+	user_names = ['user%d' % i for i in range(users)]
+	words = ['word%d' % i for i in range(vocabulary)]
+	timestamp = 1500000000
+	index = 0
+	while index < rows:
+		# like on_pubmsg: one timestamp per message, fresh string objects per row
+		user = ''.join(rnd.choice(user_names))
+		for _ in range(rnd.randint(1, 5)):
+			yield user, normalize(rnd.choice(words)), timestamp
+			index += 1
+			if index >= rows:
+				break
+		if rnd.random() < 0.01:
+			timestamp += 1
+
+def measure(counts, rows, users, vocabulary, seed):
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	counts = counts()
+	for user, word, timestamp in make_rows(rows, users, vocabulary, seed):
+		counts.add(user, word, timestamp)
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return after - before
+
+def main(args):
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Compare memory usage of the count storage backends.')
+	parser.add_argument('--rows', type=int, default=1000000)
+	parser.add_argument('--users', type=int, default=20000)
+	parser.add_argument('--vocabulary', type=int, default=5000)
+	parser.add_argument('--seed', type=int, default=0)
+	opts = parser.parse_args(args)
+
+	print('%d rows, %d users, %d words' % (opts.rows, opts.users, opts.vocabulary))
+	for name, counts in (('list', TupleList), ('buckets', Counts), ('compact', CompactCounts),
+	                     ('dedup', DedupCounts), ('compact+dedup', CompactDedupCounts)):
+		size = measure(counts, opts.rows, opts.users, opts.vocabulary, opts.seed)
+		print('%-13s %8.1f MiB %6.1f bytes/row' % (name, size / (1024 * 1024), size / opts.rows))
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
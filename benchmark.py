@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import resource
+import tempfile
+import irc.bot
+from irc.client import Event, NickMask
+from itertools import accumulate
+
+from countbot import CounterBot
+
+OPERATIONS = 'count', 'count_words', 'countint', 'count1', 'run_gc', 'dump', 'load', 'dump_snapshot', 'load_snapshot', 'restore_channels'
+
+class BenchmarkBot(CounterBot):
+	"""
+		CounterBot with a simulated clock that is never connected. Everything
+		it would send to the server is only counted.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		CounterBot.__init__(self, *args, **kwargs)
+		# normally set by the server's welcome
+		self.connection.real_nickname = self._nickname
+		self.clock = 1500000000
+		self.sent_messages = 0
+		self.sent_bytes = 0
+
+	def now(self):
+		return self.clock
+
+	def _send_raw(self, bytes):
+		self.sent_messages += 1
+		self.sent_bytes += len(bytes)
+
+	def join_fake(self, channel):
+		self.channels[channel] = irc.bot.Channel()
+		self.joined_channels.add(channel)
+
+class Workload:
+	def __init__(self, channels, users, vocabulary, zipf, words_per_message,
+	             messages_per_second, period, duration, queries_per_second, seed):
+		self.channels = ['#channel%d' % i for i in range(channels)]
+		self.users = ['user%d' % i for i in range(users)]
+		self.vocabulary = ['word%d' % i for i in range(vocabulary - 10)] + [str(i) for i in range(10)]
+		self.cum_weights = list(accumulate(1.0 / (rank ** zipf) for rank in range(1, len(self.vocabulary) + 1)))
+		self.words_per_message = words_per_message
+		self.messages_per_second = messages_per_second
+		self.period = period
+		self.duration = duration
+		self.queries_per_second = queries_per_second
+		self.rnd = random.Random(seed)
+
+	def params(self):
+		return {
+			'channels': len(self.channels),
+			'users': len(self.users),
+			'vocabulary': len(self.vocabulary),
+			'words_per_message': self.words_per_message,
+			'messages_per_second': self.messages_per_second,
+			'period': self.period,
+			'duration': self.duration,
+			'queries_per_second': self.queries_per_second,
+		}
+
+	def message(self):
+		rnd = self.rnd
+		words = rnd.choices(self.vocabulary, cum_weights=self.cum_weights, k=rnd.randint(1, self.words_per_message))
+		return Event('pubmsg', NickMask(rnd.choice(self.users) + '!user@tmi.twitch.tv'),
+			rnd.choice(self.channels), [' '.join(words)])
+
+	def query(self):
+		rnd = self.rnd
+		x = rnd.random()
+		if x < 0.4:
+			name, message = 'count', '!count'
+		elif x < 0.7:
+			name, message = 'count_words', '!count ' + ' '.join(rnd.sample(self.vocabulary[:20], 3))
+		elif x < 0.9:
+			name, message = 'countint', '!countint 1 4'
+		else:
+			name, message = 'count1', '!count1'
+		return name, Event('pubmsg', NickMask(rnd.choice(self.users) + '!user@tmi.twitch.tv'),
+			rnd.choice(self.channels), [message])
+
+def percentile(sorted_values, p):
+	if not sorted_values:
+		return None
+	index = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+	return sorted_values[index]
+
+def summarize(latencies):
+	latencies = sorted(latencies)
+	return {
+		'n': len(latencies),
+		'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else None,
+		'p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+		'p99_ms': percentile(latencies, 99) * 1000 if latencies else None,
+		'max_ms': latencies[-1] * 1000 if latencies else None,
+	}
+
+def peak_rss_kib():
+	# ru_maxrss is in KiB on Linux, but in bytes on macOS
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss // 1024 if sys.platform == 'darwin' else rss
+
+def make_bot(opts):
+	bot = BenchmarkBot(None, opts.period, 1, 512, None, None, 10, [], [], 'benchbot', [],
+		compact_counts=opts.compact, dedup_counts=opts.dedup,
+		message_cache_size=opts.message_cache_size, ingest_interval=opts.ingest_interval)
+	if opts.storage == 'sqlite':
+		bot.open_database(os.path.join(opts.tmpdir, 'benchmark.db'))
+	return bot
+
+def run(workload, opts):
+	bot = make_bot(opts)
+	if opts.tokenize_workers:
+		bot.open_tokenizer_pool(opts.tokenize_workers)
+	for channel in workload.channels:
+		bot.join_fake(channel)
+
+	latencies = dict((name, []) for name in OPERATIONS)
+	perf_counter = time.perf_counter
+	on_pubmsg = bot.on_pubmsg
+
+	messages = 0
+	ingest_time = 0.0
+	for second in range(workload.duration):
+		bot.clock += 1
+		events = [workload.message() for _ in range(workload.messages_per_second)]
+
+		start = perf_counter()
+		for event in events:
+			on_pubmsg(None, event)
+		# the reactor never runs, this is what the timer would do
+		bot.run_ingest()
+		# with tokenize workers the time until their batches are counted
+		bot.flush_ingest()
+		ingest_time += perf_counter() - start
+		messages += len(events)
+
+		for _ in range(workload.queries_per_second):
+			name, event = workload.query()
+			start = perf_counter()
+			on_pubmsg(None, event)
+			latencies[name].append(perf_counter() - start)
+
+		start = perf_counter()
+		bot.run_gc()
+		latencies['run_gc'].append(perf_counter() - start)
+
+	bot.close_tokenizer_pool()
+	rows = sum(len(data) for data in bot.channel_data.values())
+	snapshot_bytes = None
+
+	# the state of the sqlite storage is the database
+	for _ in range(opts.repeat_dump if opts.storage == 'memory' else 0):
+		start = perf_counter()
+		state = bot.dump()
+		latencies['dump'].append(perf_counter() - start)
+
+		loaded = make_bot(opts)
+		start = perf_counter()
+		loaded.load(state)
+		latencies['load'].append(perf_counter() - start)
+		state = loaded = None
+
+		fp = io.BytesIO()
+		start = perf_counter()
+		bot.dump_snapshot(fp)
+		latencies['dump_snapshot'].append(perf_counter() - start)
+		snapshot_bytes = fp.tell()
+
+		fp.seek(0)
+		loaded = make_bot(opts)
+		start = perf_counter()
+		loaded.load_snapshot(fp)
+		latencies['load_snapshot'].append(perf_counter() - start)
+
+		start = perf_counter()
+		loaded.restore_all()
+		latencies['restore_channels'].append(perf_counter() - start)
+		fp = loaded = None
+
+	return {
+		'workload': workload.params(),
+		'options': {
+			'compact_counts': opts.compact,
+			'dedup_counts': opts.dedup,
+			'message_cache_size': opts.message_cache_size,
+			'ingest_interval': opts.ingest_interval,
+			'tokenize_workers': opts.tokenize_workers,
+			'storage': opts.storage,
+		},
+		'ingest': {
+			'messages': messages,
+			'seconds': ingest_time,
+			'messages_per_second': messages / ingest_time if ingest_time else None,
+		},
+		'rows': rows,
+		'snapshot_bytes': snapshot_bytes,
+		'operations': dict((name, summarize(values)) for name, values in latencies.items()),
+		'sent_messages': bot.sent_messages,
+		'sent_bytes': bot.sent_bytes,
+		'stats': bot.stats(),
+		'peak_rss_kib': peak_rss_kib(),
+	}
+
+def main(args):
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Benchmark CounterBot offline with synthetic chat. Prints JSON.')
+	parser.add_argument('--channels', type=int, default=10)
+	parser.add_argument('--users', type=int, default=10000)
+	parser.add_argument('--vocabulary', type=int, default=5000)
+	parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the Zipfian word distribution')
+	parser.add_argument('--words-per-message', type=int, default=5)
+	parser.add_argument('--messages-per-second', type=int, default=1000, help='over all channels')
+	parser.add_argument('--period', type=int, default=300)
+	parser.add_argument('--duration', type=int, default=600, help='simulated seconds')
+	parser.add_argument('--queries-per-second', type=int, default=5, help='over all channels')
+	parser.add_argument('--repeat-dump', type=int, default=3)
+	parser.add_argument('--compact', action='store_true', default=False)
+	parser.add_argument('--dedup', action='store_true', default=False)
+	parser.add_argument('--message-cache-size', type=int, default=4096)
+	parser.add_argument('--ingest-interval', type=float, default=0, help='count chat messages in batches (flushed every simulated second)')
+	parser.add_argument('--tokenize-workers', type=int, default=0, help='tokenize batches in this many processes, needs --ingest-interval')
+	parser.add_argument('--storage', choices=('memory', 'sqlite'), default='memory')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('-o', '--output', help='write the JSON result to this file instead of stdout')
+	opts = parser.parse_args(args)
+
+	workload = Workload(opts.channels, opts.users, opts.vocabulary, opts.zipf, opts.words_per_message,
+		opts.messages_per_second, opts.period, opts.duration, opts.queries_per_second, opts.seed)
+
+	# the bot logs everything it sends
+	stdout = sys.stdout
+	with open(os.devnull, 'w') as devnull:
+		sys.stdout = devnull
+		try:
+			with tempfile.TemporaryDirectory() as opts.tmpdir:
+				result = run(workload, opts)
+		finally:
+			sys.stdout = stdout
+
+	if opts.output:
+		with open(opts.output, 'w') as fp:
+			json.dump(result, fp, indent=2, sort_keys=True)
+			fp.write('\n')
+	else:
+		json.dump(result, sys.stdout, indent=2, sort_keys=True)
+		sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -7,21 +7,243 @@ import irc.bot
 import socket
 import traceback
 import signal
+import heapq
+import json
+import sqlite3
+import threading
+import multiprocessing
 from irc.client import ServerNotConnectedError
 from time import gmtime
 from calendar import timegm
-from collections import defaultdict, OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from unicodedata import normalize as unicode_normalize
 
+from time import perf_counter
+from snapshot import ChannelSnapshot, is_snapshot, open_snapshot, read_snapshot, write_snapshot
+from journal import Journal, list_segments, read_segment, remove_segments
+from aioirc import AsyncReactor
+from shard import Coordinator, ShardSet
+from sendqueue import SendQueue
+from handoff import HandoffReceiver, HandoffServer, HandoffSender, connect as connect_handoff
+
 WORDS = re.compile(r"(?:-\w|\w)[-\w]*")
 TIME = re.compile(r"\s*(\d+)\s*([a-z]+)?\s*")
+# a duration argument of the count commands needs units, a plain number is counted
+WINDOW = re.compile(r"(?:\d+[a-z]+)+\Z")
 
 EXIT_EXCS = SystemExit, KeyboardInterrupt
+STATE_FORMATS = 'binary', 'yaml'
+# seconds per reactor iteration spent on restoring channels of a snapshot
+RESTORE_BUDGET = 0.02
+# rows restored between checks of RESTORE_BUDGET, so that a big channel is
+# restored over several reactor iterations
+RESTORE_SLICE_ROWS = 16384
+# rows are inserted in batches of this size, or before a query, or every
+# SQLITE_SAVE_INTERVAL seconds
+SQLITE_BATCH_SIZE = 1024
+SQLITE_SAVE_INTERVAL = 1
+# SQLite integers are 64 bit, !countint can't count bigger numbers
+SQLITE_MININT = -(1 << 63)
+SQLITE_MAXINT = (1 << 63) - 1
+STORAGES = 'memory', 'sqlite'
+ENGINES = 'irc', 'asyncio'
+JOURNALED = frozenset(('add_words', 'add_messages', 'set_period', 'set_minint', 'set_maxint', 'set_result_limit',
+                       'clear_counts', 'join_channel', 'part_channel', 'set_gcinterval'))
 ROW_TYPES = tuple, list
+# a query result that isn't cached (None is a result)
+MISSING = object()
+# seconds after the welcome after which a new process tells the old one to
+# exit even if not all channels are joined yet
+HANDOFF_JOIN_TIMEOUT = 30
+# seconds between the load reports of shard workers
+SHARD_REPORT_INTERVAL = 5
+# buffered chat messages are counted after ingest_interval seconds or when
+# there are this many
+INGEST_BATCH_SIZE = 512
+
+try:
+	is_ascii = str.isascii
+except AttributeError:
+	# Python < 3.7
+	ASCII = re.compile(r"[\x00-\x7f]*\Z")
+	def is_ascii(text):
+		return ASCII.match(text) is not None
 
 def normalize(word):
+	if is_ascii(word):
+		# NFC doesn't change ASCII
+		return word.lower()
 	return unicode_normalize('NFC', word).lower()
 
+class Tokenizer:
+	"""
+		WORDS.findall() + normalize() with a bounded LRU cache from message
+		text to its normalized words and a bounded cache of normalized
+		words. Chat repeats the same messages (copypasta, emote spam) and
+		words all the time.
+	"""
+	__slots__ = 'message_cache', 'word_cache', 'max_messages', 'max_words', 'hits', 'misses'
+
+	def __init__(self, max_messages=4096, max_words=16384):
+		self.message_cache = OrderedDict()
+		self.word_cache = {}
+		self.max_messages = max_messages
+		self.max_words = max_words
+		self.hits = 0
+		self.misses = 0
+
+	def tokenize(self, message):
+		cache = self.message_cache
+		words = cache.get(message)
+		if words is not None:
+			cache.move_to_end(message)
+			self.hits += 1
+			return words
+
+		self.misses += 1
+		if is_ascii(message):
+			# lower() can't change word boundaries of ASCII text
+			words = tuple(WORDS.findall(message.lower()))
+		else:
+			word_cache = self.word_cache
+			normalize = self.normalize
+			words = tuple([word_cache.get(word) or normalize(word) for word in WORDS.findall(message)])
+
+		if self.max_messages > 0:
+			cache[message] = words
+			if len(cache) > self.max_messages:
+				cache.popitem(last=False)
+
+		return words
+
+	def normalize(self, word):
+		normalized = normalize(word)
+		cache = self.word_cache
+		if len(cache) >= self.max_words:
+			# cheaper than LRU bookkeeping on every word
+			cache.clear()
+		cache[word] = normalized
+		return normalized
+
+# Tokenizer of a TokenizerPool worker process
+worker_tokenizer = None
+
+def init_tokenize_worker(message_cache_size):
+	global worker_tokenizer
+	# the parent handles SIGINT and terminates the pool with SIGTERM, which
+	# mustn't run the bot's shutdown handler inherited through fork()
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	worker_tokenizer = Tokenizer(message_cache_size)
+
+def tokenize_messages(messages):
+	"""
+		(index, words) of the messages that have any words. Runs in a
+		TokenizerPool worker process.
+	"""
+	tokenize = worker_tokenizer.tokenize
+	tokenized = []
+	for index, message in enumerate(messages):
+		words = tokenize(message)
+		if words:
+			tokenized.append((index, words))
+	return tokenized
+
+class TokenizerPool:
+	"""
+		Tokenizes batches of chat messages in worker processes, so ingest
+		isn't bound to the core of the reactor thread. Only the message
+		texts are sent to the workers and only the words come back, the
+		counts stay in the bot. done() returns the batches in the order
+		they were submitted, so the rows of a channel stay in order.
+	"""
+	__slots__ = 'pool', 'pending'
+
+	def __init__(self, processes, message_cache_size=4096):
+		# fork, the workers need nothing but this module
+		context = multiprocessing.get_context('fork')
+		self.pool = context.Pool(processes, init_tokenize_worker, (message_cache_size,))
+		# (channel, users, timestamp, AsyncResult)
+		self.pending = deque()
+
+	def __len__(self):
+		return len(self.pending)
+
+	def submit(self, channel, buffer, timestamp):
+		users = [user for user, message in buffer]
+		messages = [message for user, message in buffer]
+		self.pending.append((channel, users, timestamp, self.pool.apply_async(tokenize_messages, (messages,))))
+
+	def done(self, wait=False):
+		"""
+			(channel, [(user, words), ...], timestamp) of the tokenized
+			batches, up to the first that isn't finished yet or with wait
+			all of them.
+		"""
+		pending = self.pending
+		batches = []
+		while pending:
+			channel, users, timestamp, result = pending[0]
+			if not wait and not result.ready():
+				break
+			pending.popleft()
+			batches.append((channel, [(users[index], words) for index, words in result.get()], timestamp))
+		return batches
+
+	def discard(self, channel):
+		"""
+			Drop the pending batches of the channel.
+		"""
+		pending = self.pending
+		if any(batch[0] == channel for batch in pending):
+			self.pending = deque(batch for batch in pending if batch[0] != channel)
+
+	def close(self):
+		self.pool.terminate()
+		self.pool.join()
+
+def parse_bool(value):
+	if type(value) is bool:
+		return value
+	value = value.lower()
+	if value == 'true' or value == 'yes' or value == 'on' or value == '1':
+		return True
+	elif value == 'false' or value == 'no' or value == 'off' or value == '0':
+		return False
+	else:
+		raise ValueError(value)
+
+def parse_word_int(word):
+	"""
+		The number of a counted word for !countint, or None.
+	"""
+	# every word that int() accepts ends in a decimal digit, this avoids
+	# raising and catching an exception for almost all words
+	if not word[-1].isdecimal():
+		return None
+	try:
+		return int(word, 10)
+	except ValueError:
+		return None
+
+def count_order(item):
+	word, count = item
+	return -count, word
+
+def top_counts(items, limit):
+	"""
+		The (word, count) items sorted by descending count and then word,
+		truncated to limit (None means unlimited).
+	"""
+	if limit is not None:
+		return heapq.nsmallest(limit, items, key=count_order)
+	return sorted(items, key=count_order)
+
 def normalize_channel(channel):
 	channel = channel.lower()
 	if not channel.startswith('#'):
@@ -70,6 +292,19 @@ def parse_time(time):
 
 	return seconds
 
+def parse_window(arg):
+	"""
+		Seconds of a leading duration argument of the count commands (e.g.
+		30s or 1m30s) or None if it isn't one.
+	"""
+	if not WINDOW.match(arg):
+		return None
+	try:
+		seconds = parse_time(arg)
+	except ValueError:
+		return None
+	return seconds or None
+
 def format_time(seconds):
 	if seconds == 0:
 		return '0sec'
@@ -99,17 +334,596 @@ def format_time(seconds):
 
 	return time
 
-class ChannelData:
-	__slots__ = 'period', 'counts', 'minint', 'maxint', 'result_limit'
+def chunk_message(prefix, message, maxlen):
+	"""
+		The lines prefix + chunk + CRLF of the UTF-8 encoded message, split
+		into chunks of at most maxlen bytes at the last space or tab if
+		possible and else not in the middle of a multi-byte sequence.
+	"""
+	N = len(message)
+	if not maxlen or N <= maxlen:
+		return [b''.join((prefix, message, b'\r\n'))]
+
+	rfind = message.rfind
+	lines = []
+	append = lines.append
+	index = 0
+	while index < N:
+		next_index = index + maxlen
+		if next_index >= N:
+			append(b''.join((prefix, message[index:], b'\r\n')))
+			break
+
+		# the first byte of the next chunk may be the space itself
+		space_index = rfind(b' ', index, next_index + 1)
+		# only look for a tab after the space, chat has hardly any
+		tab_index = rfind(b'\t', space_index + 1 if space_index >= 0 else index, next_index + 1)
+		if tab_index > space_index:
+			space_index = tab_index
+
+		if space_index < 0:
+			# at least don't cut in the middle of a multi-byte sequence
+			while next_index > index:
+				byte = message[next_index]
+				if byte < 128 or byte >= 192:
+					break
+				next_index -= 1
+			chunk = message[index:next_index]
+		else:
+			chunk = message[index:space_index].rstrip()
+			next_index = space_index + 1
+
+		append(b''.join((prefix, chunk, b'\r\n')))
+		index = next_index
+
+	return lines
+
+def write_file(path, write, mode='wb'):
+	"""
+		Write a file by calling write(fp) so that it is either replaced as a
+		whole or not at all.
+	"""
+	tmpfile = path + '.tmp'
+	with open(tmpfile, mode) as fp:
+		write(fp)
+		fp.flush()
+		os.fsync(fp.fileno())
+	os.replace(tmpfile, path)
+
+class SymbolTable:
+	__slots__ = 'symbols', 'ids'
+
+	def __init__(self):
+		self.symbols = []
+		self.ids = {}
+
+	def __len__(self):
+		return len(self.symbols)
+
+	def intern(self, symbol):
+		symbol_id = self.ids.get(symbol)
+		if symbol_id is None:
+			symbol_id = self.ids[symbol] = len(self.symbols)
+			self.symbols.append(symbol)
+		return symbol_id
+
+	def copy(self):
+		copy = SymbolTable()
+		copy.symbols = self.symbols[:]
+		copy.ids = self.ids.copy()
+		return copy
+
+class Bucket:
+	__slots__ = 'timestamp', 'position', 'users', 'words'
+
+	def __init__(self, timestamp, position, users, words):
+		self.timestamp = timestamp
+		self.position = position
+		self.users = users
+		self.words = words
+
+	def __len__(self):
+		return len(self.users)
+
+class KeyBucket:
+	__slots__ = 'timestamp', 'position', 'keys'
+
+	def __init__(self, timestamp, position):
+		self.timestamp = timestamp
+		self.position = position
+		# insertion ordered set of row keys
+		self.keys = {}
+
+	def __len__(self):
+		return len(self.keys)
+
+class Counts:
+	"""
+		Storage of (user, word, timestamp) rows, grouped into one bucket per
+		timestamp (i.e. per second) in a deque, oldest first. Expiring rows
+		pops whole buckets from the left and timestamp boundaries are found by
+		bisecting the buckets, so it costs time proportional to the expired
+		rows, not to the retained rows.
+	"""
+	__slots__ = 'buckets', 'length', 'offset'
+
+	def __init__(self, rows=()):
+		self.buckets = deque()
+		self.length = 0
+		# number of buckets ever removed from the left, so that
+		# offset + index is a stable position of a bucket (Bucket.position)
+		self.offset = 0
+		for user, word, timestamp in rows:
+			self.add(user, word, timestamp)
+
+	def __len__(self):
+		return self.length
+
+	def make_bucket(self, timestamp, position):
+		return Bucket(timestamp, position, [], [])
+
+	def last_bucket(self, timestamp):
+		buckets = self.buckets
+		if buckets and buckets[-1].timestamp >= timestamp:
+			# same second (or the clock went backwards, keep buckets sorted anyway)
+			return buckets[-1]
+		bucket = self.make_bucket(timestamp, self.offset + len(buckets))
+		buckets.append(bucket)
+		return bucket
+
+	def add(self, user, word, timestamp):
+		"""
+			Add a row. Returns the bucket that held an older row of the same
+			user and word that was replaced by this row, or None.
+		"""
+		bucket = self.last_bucket(timestamp)
+		bucket.users.append(user)
+		bucket.words.append(word)
+		self.length += 1
+		return None
 
-	def __init__(self, period, minint=None, maxint=None, result_limit=None, counts=None):
+	def copy(self):
+		"""
+			Copy that isn't affected by later changes of this object, e.g. to
+			write a snapshot of it in another thread.
+		"""
+		copy = type(self)()
+		copy.buckets = deque(self.copy_bucket(bucket) for bucket in self.buckets)
+		copy.length = self.length
+		copy.offset = self.offset
+		return copy
+
+	def copy_bucket(self, bucket):
+		return Bucket(bucket.timestamp, bucket.position, bucket.users[:], bucket.words[:])
+
+	def load_columns(self, users, words, timestamps, sizes, user_ids, word_ids):
+		"""
+			Add the rows given in the form of ChannelSnapshot, the reverse of
+			snapshot_columns().
+		"""
+		index = 0
+		for timestamp, size in zip(timestamps, sizes):
+			end = index + size
+			bucket = self.last_bucket(timestamp)
+			bucket.users.extend([users[user_id] for user_id in user_ids[index:end]])
+			bucket.words.extend([words[word_id] for word_id in word_ids[index:end]])
+			index = end
+		self.length += index
+
+	def snapshot_columns(self):
+		"""
+			All rows in the form of ChannelSnapshot:
+			(users, words, timestamps, sizes, user_ids, word_ids)
+		"""
+		users = SymbolTable()
+		words = SymbolTable()
+		timestamps = array('q')
+		sizes = array('I')
+		user_ids = array('I')
+		word_ids = array('I')
+		for bucket in self.buckets:
+			size = 0
+			for user, word in self.rows(bucket):
+				user_ids.append(users.intern(user))
+				word_ids.append(words.intern(word))
+				size += 1
+			if size:
+				timestamps.append(bucket.timestamp)
+				sizes.append(size)
+		return users.symbols, words.symbols, timestamps, sizes, user_ids, word_ids
+
+	def key(self, user, word):
+		return user, word
+
+	def pair(self, key):
+		return key
+
+	def rows(self, bucket):
+		return zip(bucket.users, bucket.words)
+
+	def __iter__(self):
+		for bucket in self.buckets:
+			timestamp = bucket.timestamp
+			for user, word in self.rows(bucket):
+				yield user, word, timestamp
+
+	def bisect(self, timestamp):
+		"""
+			Index of the first bucket with a timestamp >= the given timestamp.
+		"""
+		buckets = self.buckets
+		lo = 0
+		hi = len(buckets)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if buckets[mid].timestamp < timestamp:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def expire(self, timestamp):
+		"""
+			Delete all rows older than timestamp. Returns the number of deleted rows.
+		"""
+		buckets = self.buckets
+		rowcount = 0
+		for _ in range(self.bisect(timestamp)):
+			rowcount += len(buckets.popleft())
+			self.offset += 1
+		self.length -= rowcount
+		return rowcount
+
+	def clear(self):
+		rowcount = self.length
+		self.offset += len(self.buckets)
+		self.buckets.clear()
+		self.length = 0
+		return rowcount
+
+class CompactCounts(Counts):
+	"""
+		Counts that intern users and words to integer ids through per-channel
+		symbol tables and keep the buckets as parallel arrays of ids, which is
+		8 bytes per row instead of two strings per row.
+	"""
+	def __init__(self, rows=()):
+		self.users = SymbolTable()
+		self.words = SymbolTable()
+		super().__init__(rows)
+
+	def make_bucket(self, timestamp, position):
+		return Bucket(timestamp, position, array('I'), array('I'))
+
+	def add(self, user, word, timestamp):
+		bucket = self.last_bucket(timestamp)
+		bucket.users.append(self.users.intern(user))
+		bucket.words.append(self.words.intern(word))
+		self.length += 1
+		return None
+
+	def copy(self):
+		copy = super().copy()
+		copy.users = self.users.copy()
+		copy.words = self.words.copy()
+		return copy
+
+	def load_columns(self, users, words, timestamps, sizes, user_ids, word_ids):
+		# when restored in slices the tables are already interned after the first
+		user_map = None if self.users.symbols[:len(users)] == users else [self.users.intern(user) for user in users]
+		word_map = None if self.words.symbols[:len(words)] == words else [self.words.intern(word) for word in words]
+		# into empty symbol tables the ids stay the same
+		if user_map is not None and user_map == list(range(len(users))):
+			user_map = None
+		if word_map is not None and word_map == list(range(len(words))):
+			word_map = None
+		index = 0
+		for timestamp, size in zip(timestamps, sizes):
+			end = index + size
+			bucket = self.last_bucket(timestamp)
+			if user_map is None:
+				bucket.users.extend(user_ids[index:end])
+			else:
+				bucket.users.extend([user_map[user_id] for user_id in user_ids[index:end]])
+			if word_map is None:
+				bucket.words.extend(word_ids[index:end])
+			else:
+				bucket.words.extend([word_map[word_id] for word_id in word_ids[index:end]])
+			index = end
+		self.length += index
+
+	def snapshot_columns(self):
+		# the buckets already are id columns, just use the whole symbol tables
+		timestamps = array('q')
+		sizes = array('I')
+		user_ids = array('I')
+		word_ids = array('I')
+		for bucket in self.buckets:
+			if bucket.users:
+				timestamps.append(bucket.timestamp)
+				sizes.append(len(bucket.users))
+				user_ids.extend(bucket.users)
+				word_ids.extend(bucket.words)
+		return list(self.users.symbols), list(self.words.symbols), timestamps, sizes, user_ids, word_ids
+
+	def key(self, user, word):
+		return self.users.intern(user) << 32 | self.words.intern(word)
+
+	def pair(self, key):
+		return self.users.symbols[key >> 32], self.words.symbols[key & 0xFFFFFFFF]
+
+	def rows(self, bucket):
+		users = self.users.symbols
+		words = self.words.symbols
+		return ((users[user_id], words[word_id]) for user_id, word_id in zip(bucket.users, bucket.words))
+
+	def expire(self, timestamp):
+		rowcount = super().expire(timestamp)
+
+		N = self.length
+		# Symbols are never released individually. Rebuild the tables once
+		# most of their entries can't be referenced anymore.
+		if len(self.users) > 2 * N + 64 or len(self.words) > 2 * N + 64:
+			old_users = self.users.symbols
+			old_words = self.words.symbols
+			self.users = SymbolTable()
+			self.words = SymbolTable()
+			self.reintern_buckets(old_users, old_words)
+
+		return rowcount
+
+	def reintern_buckets(self, old_users, old_words):
+		for bucket in self.buckets:
+			self.reintern(bucket, old_users, old_words)
+
+	def reintern(self, bucket, old_users, old_words):
+		users = self.users
+		words = self.words
+		bucket.users = array('I', (users.intern(old_users[user_id]) for user_id in bucket.users))
+		bucket.words = array('I', (words.intern(old_words[word_id]) for word_id in bucket.words))
+
+	def clear(self):
+		rowcount = super().clear()
+		self.users = SymbolTable()
+		self.words = SymbolTable()
+		return rowcount
+
+class DedupCounts(Counts):
+	"""
+		Counts that only keep the latest row of every (user, word) pair.
+		Mentioning a word again moves its row to the newest bucket instead of
+		adding a row, so memory is bounded by the number of distinct pairs
+		instead of the number of messages. Because words are only counted
+		once per user this doesn't change any count results.
+	"""
+	def __init__(self, rows=()):
+		# row key -> bucket that holds the row
+		self.latest = {}
+		super().__init__(rows)
+
+	def make_bucket(self, timestamp, position):
+		return KeyBucket(timestamp, position)
+
+	def add(self, user, word, timestamp):
+		key = self.key(user, word)
+		bucket = self.last_bucket(timestamp)
+		latest = self.latest
+		old_bucket = latest.get(key)
+		if old_bucket is not bucket:
+			if old_bucket is None:
+				self.length += 1
+			else:
+				keys = old_bucket.keys
+				del keys[key]
+				if not keys:
+					# dicts don't shrink when deleting
+					old_bucket.keys = {}
+			bucket.keys[key] = None
+			latest[key] = bucket
+		return old_bucket
+
+	def copy(self):
+		copy = super().copy()
+		latest = copy.latest
+		for bucket in copy.buckets:
+			latest.update(dict.fromkeys(bucket.keys, bucket))
+		return copy
+
+	def copy_bucket(self, bucket):
+		copy = KeyBucket(bucket.timestamp, bucket.position)
+		copy.keys = bucket.keys.copy()
+		return copy
+
+	def load_columns(self, users, words, timestamps, sizes, user_ids, word_ids):
+		add = self.add
+		index = 0
+		for timestamp, size in zip(timestamps, sizes):
+			for row in range(index, index + size):
+				add(users[user_ids[row]], words[word_ids[row]], timestamp)
+			index += size
+
+	# the generic implementations, also for CompactDedupCounts
+	snapshot_columns = Counts.snapshot_columns
+
+	def rows(self, bucket):
+		pair = self.pair
+		return (pair(key) for key in bucket.keys)
+
+	def expire(self, timestamp):
+		buckets = self.buckets
+		latest = self.latest
+		for index in range(self.bisect(timestamp)):
+			for key in buckets[index].keys:
+				del latest[key]
+		return super().expire(timestamp)
+
+	def clear(self):
+		self.latest.clear()
+		return super().clear()
+
+class CompactDedupCounts(DedupCounts, CompactCounts):
+	"""
+		DedupCounts with interned users and words, a row key is
+		user_id << 32 | word_id.
+	"""
+	def reintern_buckets(self, old_users, old_words):
+		self.latest = {}
+		super().reintern_buckets(old_users, old_words)
+
+	def reintern(self, bucket, old_users, old_words):
+		users = self.users
+		words = self.words
+		latest = self.latest
+		keys = {}
+		for key in bucket.keys:
+			new_key = users.intern(old_users[key >> 32]) << 32 | words.intern(old_words[key & 0xFFFFFFFF])
+			keys[new_key] = None
+			latest[new_key] = bucket
+		bucket.keys = keys
+
+class Leaderboard:
+	"""
+		Words grouped by their count, with the distinct counts kept in order,
+		so the top K words can be read without sorting all counted words.
+		Counts change by one at a time, so moving a word is O(1) and only a
+		new or vanished count touches the (short) sorted list of counts.
+	"""
+	__slots__ = 'levels', 'sorted_counts'
+
+	def __init__(self):
+		# count -> set of words with that count
+		self.levels = {}
+		self.sorted_counts = []
+
+	def __bool__(self):
+		return bool(self.levels)
+
+	def move(self, word, old_count, new_count):
+		levels = self.levels
+		if old_count:
+			level = levels[old_count]
+			level.remove(word)
+			if not level:
+				del levels[old_count]
+				sorted_counts = self.sorted_counts
+				del sorted_counts[bisect_left(sorted_counts, old_count)]
+
+		if new_count:
+			level = levels.get(new_count)
+			if level is None:
+				levels[new_count] = {word}
+				insort(self.sorted_counts, new_count)
+			else:
+				level.add(word)
+
+	def top(self, limit):
+		"""
+			The same as top_counts() over all words, in O(K log K) for the
+			usual small levels.
+		"""
+		counts = []
+		levels = self.levels
+		for count in reversed(self.sorted_counts):
+			level = levels[count]
+			if limit is not None:
+				remaining = limit - len(counts)
+				if remaining <= 0:
+					break
+				if len(level) > remaining:
+					counts.extend((word, count) for word in heapq.nsmallest(remaining, level))
+					break
+			counts.extend((word, count) for word in sorted(level))
+		return counts
+
+	def clear(self):
+		self.levels.clear()
+		del self.sorted_counts[:]
+
+class BaseChannelData:
+	"""
+		Settings and the result cache of a channel. The counts are kept by
+		the subclasses, which implement add(), update_window(), the queries
+		count_words(), count_ints(), top() and top1(), window() (the same
+		queries over a shorter window), gc() and clear().
+	"""
+	__slots__ = ('period', 'minint', 'maxint', 'result_limit',
+	             'version', 'result_cache', 'cache_stamp', 'last_reply')
+
+	def __init__(self, period, minint=None, maxint=None, result_limit=None):
 		self.period = period
-		self.counts = counts if counts is not None else []
 		self.minint = minint
 		self.maxint = maxint
 		self.result_limit = result_limit
+		# incremented whenever rows are added or removed (other than by expiry)
+		self.version = 0
+		# query results of the current cache_stamp, see lookup()
+		self.result_cache = {}
+		self.cache_stamp = None
+		# (cache_stamp, message) of the last count result posted in this channel
+		self.last_reply = None
 		# maybe more in the future
 
+	def lookup(self, key, timestamp):
+		"""
+			Cached result for the window ending at timestamp or MISSING.
+			The cache is emptied whenever rows were added, the window end
+			moved or the period was changed. Afterwards cache_stamp is the
+			stamp to pass to cache_result().
+		"""
+		stamp = (self.version, timestamp, self.period)
+		if self.cache_stamp != stamp:
+			self.result_cache.clear()
+			self.cache_stamp = stamp
+			return MISSING
+		return self.result_cache.get(key, MISSING)
+
+	def cache_result(self, stamp, key, result):
+		"""
+			Cache a result that was computed for stamp, unless rows were
+			added, the window end moved or the period was changed since.
+		"""
+		if self.cache_stamp == stamp:
+			self.result_cache[key] = result
+
+	def drop(self):
+		"""
+			The channel is deleted.
+		"""
+		pass
+
+class ChannelData(BaseChannelData):
+	__slots__ = ('counts', 'word_users', 'window_start', 'word_ints', 'int_users', 'sorted_ints',
+	             'leaderboard', 'leaderboard1')
+
+	def __init__(self, period, minint=None, maxint=None, result_limit=None, counts=None):
+		BaseChannelData.__init__(self, period, minint, maxint, result_limit)
+		self.counts = counts if counts is not None else Counts()
+		# word -> {user: number of rows of that user and word in the buckets
+		# starting at position window_start (see Counts.offset)}
+		# The index is built lazily by update_window(), so loaded rows start outside of it.
+		self.word_users = {}
+		self.window_start = self.counts.offset + len(self.counts.buckets)
+		# word -> number, for the words in word_users that are numbers
+		self.word_ints = {}
+		# number -> {user: number of words in word_users of that user that are this number}
+		# (e.g. 1 and 01 are both 1)
+		self.int_users = {}
+		# the keys of int_users in order, for range queries
+		self.sorted_ints = []
+		# user counts of all words and of one-letter words
+		self.leaderboard = Leaderboard()
+		self.leaderboard1 = Leaderboard()
+
+	def __len__(self):
+		return len(self.counts)
+
+	def oldest(self):
+		"""
+			Timestamp of the oldest row or None.
+		"""
+		counts = self.counts
+		return counts.buckets[0].timestamp if counts else None
+
 	def dump(self):
 		return {
 			'period': self.period,
@@ -119,21 +933,726 @@ class ChannelData:
 			'result_limit': self.result_limit
 		}
 
-	def find_first_non_gc_count(self, periodts):
-		for index, (user, word, timestamp) in enumerate(self.counts):
-			if timestamp >= periodts:
-				return index
-		return len(self.counts)
+	def copy(self):
+		return ChannelData(self.period, self.minint, self.maxint, self.result_limit, self.counts.copy())
+
+	def snapshot(self, channel):
+		return ChannelSnapshot(channel, self.period, self.minint, self.maxint, self.result_limit,
+			*self.counts.snapshot_columns())
+
+	def add(self, user, word, timestamp):
+		self.version += 1
+		counts = self.counts
+		old_bucket = counts.add(user, word, timestamp)
+		# The row can land in the last bucket while that is not yet part of
+		# the window (e.g. after loading), update_window() counts it then.
+		window_start = self.window_start
+		indexed = counts.buckets[-1].position >= window_start
+		replaced = old_bucket is not None and old_bucket.position >= window_start
+		if indexed and not replaced:
+			self.add_vote(user, word)
+		elif replaced and not indexed:
+			self.remove_vote(user, word)
+
+	def add_vote(self, user, word):
+		users = self.word_users.get(word)
+		if users is None:
+			self.word_users[word] = {user: 1}
+			self.move_word(word, 0, 1)
+			num = parse_word_int(word)
+			if num is not None:
+				self.word_ints[word] = num
+				self.add_int_vote(user, num)
+		else:
+			count = users.get(user, 0)
+			users[user] = count + 1
+			if not count:
+				user_count = len(users)
+				self.move_word(word, user_count - 1, user_count)
+				num = self.word_ints.get(word)
+				if num is not None:
+					self.add_int_vote(user, num)
+
+	def remove_vote(self, user, word):
+		users = self.word_users[word]
+		count = users[user] - 1
+		if count:
+			users[user] = count
+		else:
+			del users[user]
+			user_count = len(users)
+			self.move_word(word, user_count + 1, user_count)
+			num = self.word_ints.get(word)
+			if num is not None:
+				self.remove_int_vote(user, num)
+			if not users:
+				del self.word_users[word]
+				if num is not None:
+					del self.word_ints[word]
+
+	def move_word(self, word, old_count, new_count):
+		self.leaderboard.move(word, old_count, new_count)
+		if len(word) == 1:
+			self.leaderboard1.move(word, old_count, new_count)
+
+	def add_int_vote(self, user, num):
+		users = self.int_users.get(num)
+		if users is None:
+			self.int_users[num] = {user: 1}
+			insort(self.sorted_ints, num)
+		else:
+			users[user] = users.get(user, 0) + 1
+
+	def remove_int_vote(self, user, num):
+		users = self.int_users[num]
+		count = users[user] - 1
+		if count:
+			users[user] = count
+		else:
+			del users[user]
+			if not users:
+				del self.int_users[num]
+				sorted_ints = self.sorted_ints
+				del sorted_ints[bisect_left(sorted_ints, num)]
+
+	def count_words(self, words):
+		"""
+			Number of users per word of words.
+		"""
+		word_users = self.word_users
+		return dict((word, len(word_users.get(word, ()))) for word in words)
+
+	def top(self, limit):
+		"""
+			top_counts() of all words or None if there are none.
+		"""
+		leaderboard = self.leaderboard
+		return leaderboard.top(limit) if leaderboard else None
+
+	def top1(self, limit):
+		"""
+			top_counts() of all one-letter words or None if there are none.
+		"""
+		leaderboard = self.leaderboard1
+		return leaderboard.top(limit) if leaderboard else None
+
+	def count_ints(self, minint, maxint):
+		"""
+			Number of users per number in [minint, maxint] (None means unbounded).
+		"""
+		sorted_ints = self.sorted_ints
+		start = bisect_left(sorted_ints, minint) if minint is not None else 0
+		end = bisect_right(sorted_ints, maxint) if maxint is not None else len(sorted_ints)
+		int_users = self.int_users
+		return dict((num, len(int_users[num])) for num in sorted_ints[start:end])
+
+	def update_window(self, periodts):
+		"""
+			Make word_users reflect exactly the rows with a timestamp >= periodts.
+		"""
+		counts = self.counts
+		buckets = counts.buckets
+		index = self.window_start - counts.offset
+		N = len(buckets)
+
+		# rows that fell out of the period
+		while index < N:
+			bucket = buckets[index]
+			if bucket.timestamp >= periodts:
+				break
+			for user, word in counts.rows(bucket):
+				self.remove_vote(user, word)
+			index += 1
+
+		# rows that are back inside the period (it was made longer or rows were loaded)
+		while index > 0:
+			bucket = buckets[index - 1]
+			if bucket.timestamp < periodts:
+				break
+			index -= 1
+			for user, word in counts.rows(bucket):
+				self.add_vote(user, word)
+
+		self.window_start = index + counts.offset
+
+	def gc(self, periodts):
+		self.update_window(periodts)
+		return self.counts.expire(periodts)
+
+	def clear(self):
+		self.version += 1
+		rowcount = self.counts.clear()
+		self.word_users.clear()
+		self.word_ints.clear()
+		self.int_users.clear()
+		del self.sorted_ints[:]
+		self.leaderboard.clear()
+		self.leaderboard1.clear()
+		self.window_start = self.counts.offset
+		return rowcount
+
+	def window(self, periodts):
+		"""
+			The counts of the rows with a timestamp >= periodts, for a window
+			shorter than the period.
+		"""
+		counts = self.counts
+		buckets = counts.buckets
+		start = counts.bisect(periodts)
+		rows = counts.rows
+		# deques are fast at the ends, the window is at the right one
+		return Window(row for bucket in islice(reversed(buckets), len(buckets) - start) for row in rows(bucket))
+
+class Window:
+	"""
+		The queries of ChannelData over only some of the latest rows. It is
+		built from just these rows, so it costs time proportional to the
+		size of the window instead of to the period.
+	"""
+	__slots__ = 'word_users'
+
+	def __init__(self, rows):
+		# word -> set of users
+		word_users = self.word_users = {}
+		for user, word in rows:
+			users = word_users.get(word)
+			if users is None:
+				word_users[word] = {user}
+			else:
+				users.add(user)
+
+	def count_words(self, words):
+		word_users = self.word_users
+		return dict((word, len(word_users.get(word, ()))) for word in words)
+
+	def top(self, limit):
+		word_users = self.word_users
+		if not word_users:
+			return None
+		return top_counts(((word, len(users)) for word, users in word_users.items()), limit)
+
+	def top1(self, limit):
+		items = [(word, len(users)) for word, users in self.word_users.items() if len(word) == 1]
+		return top_counts(items, limit) if items else None
+
+	def count_ints(self, minint, maxint):
+		# 1 and 01 are the same number
+		int_users = {}
+		for word, users in self.word_users.items():
+			num = parse_word_int(word)
+			if num is None or (minint is not None and num < minint) or (maxint is not None and num > maxint):
+				continue
+			num_users = int_users.get(num)
+			if num_users is None:
+				int_users[num] = set(users)
+			else:
+				num_users.update(users)
+		return dict((num, len(users)) for num, users in int_users.items())
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counts (
+	channel TEXT NOT NULL,
+	user TEXT NOT NULL,
+	word TEXT NOT NULL,
+	timestamp INTEGER NOT NULL,
+	num INTEGER,
+	PRIMARY KEY (channel, user, word)
+);
+CREATE INDEX IF NOT EXISTS counts_channel_timestamp ON counts (channel, timestamp);
+CREATE INDEX IF NOT EXISTS counts_channel_word ON counts (channel, word);
+CREATE TABLE IF NOT EXISTS channels (
+	channel TEXT NOT NULL PRIMARY KEY,
+	period INTEGER NOT NULL,
+	minint INTEGER,
+	maxint INTEGER,
+	result_limit INTEGER
+);
+CREATE TABLE IF NOT EXISTS settings (
+	key TEXT NOT NULL PRIMARY KEY,
+	value TEXT NOT NULL
+);
+"""
+
+def sqlite_int(value):
+	if value is None or value < SQLITE_MININT or value > SQLITE_MAXINT:
+		return None
+	return value
+
+def sqlite_bound(value, default):
+	if value is None:
+		return default
+	return min(max(value, SQLITE_MININT), SQLITE_MAXINT)
+
+class SqliteStore:
+	"""
+		Counts and settings of all channels in an SQLite database (in WAL
+		mode). Only the latest row of every channel, user and word is kept,
+		like with DedupCounts. Rows are inserted in batches, queries insert
+		the pending rows first.
+
+		Queries from other threads than the one that opened the store use
+		a read-only connection per thread. They see the rows committed when
+		the query started (the pending rows must be flushed before), and
+		don't hold the GIL while SQLite runs them.
+	"""
+	__slots__ = 'path', 'db', 'pending', 'thread_id', 'local', 'readers', 'readers_lock'
+
+	def __init__(self, path):
+		self.path = path
+		db = self.db = sqlite3.connect(path)
+		db.execute('PRAGMA journal_mode=WAL')
+		db.execute('PRAGMA synchronous=NORMAL')
+		db.executescript(SQLITE_SCHEMA)
+		self.pending = []
+		self.thread_id = threading.get_ident()
+		self.local = threading.local()
+		self.readers = []
+		self.readers_lock = threading.Lock()
+
+	def add(self, channel, user, word, timestamp):
+		pending = self.pending
+		pending.append((channel, user, word, timestamp, sqlite_int(parse_word_int(word))))
+		if len(pending) >= SQLITE_BATCH_SIZE:
+			self.flush()
+
+	def flush(self):
+		if self.pending:
+			with self.db:
+				self.db.executemany(
+					'INSERT OR REPLACE INTO counts (channel, user, word, timestamp, num) VALUES (?, ?, ?, ?, ?)',
+					self.pending)
+			self.pending = []
+
+	def query(self, sql, params):
+		if threading.get_ident() != self.thread_id:
+			return self.reader().execute(sql, params).fetchall()
+		self.flush()
+		return self.db.execute(sql, params).fetchall()
+
+	def reader(self):
+		db = getattr(self.local, 'db', None)
+		if db is None:
+			# closed by close() in the thread of the store
+			db = self.local.db = sqlite3.connect('file:%s?mode=ro' % quote(os.path.abspath(self.path)),
+				uri=True, check_same_thread=False)
+			with self.readers_lock:
+				self.readers.append(db)
+		return db
+
+	def modify(self, sql, params):
+		"""
+			Returns the number of changed rows.
+		"""
+		self.flush()
+		with self.db:
+			return self.db.execute(sql, params).rowcount
+
+	def channels(self):
+		return self.db.execute('SELECT channel, period, minint, maxint, result_limit FROM channels').fetchall()
+
+	def load_settings(self):
+		row = self.db.execute("SELECT value FROM settings WHERE key = 'bot'").fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	def save(self, settings, channels):
+		"""
+			Insert pending rows and save the bot settings and the settings of
+			the (channel, ChannelData) pairs of channels.
+		"""
+		self.flush()
+		with self.db:
+			self.db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('bot', ?)",
+				(json.dumps(settings),))
+			self.db.executemany(
+				'INSERT OR REPLACE INTO channels (channel, period, minint, maxint, result_limit) VALUES (?, ?, ?, ?, ?)',
+				# the queries clamp the bounds to 64 bit integers anyway
+				[(channel, data.period, sqlite_bound(data.minint, None), sqlite_bound(data.maxint, None),
+				  sqlite_bound(data.result_limit, None)) for channel, data in channels])
+
+	def close(self):
+		self.flush()
+		self.db.close()
+		with self.readers_lock:
+			for db in self.readers:
+				db.close()
+			del self.readers[:]
+
+class SqliteChannelData(BaseChannelData):
+	"""
+		The counts of a channel in an SqliteStore. The queries are aggregates
+		over the rows of the window, there is no in-memory index.
+	"""
+	__slots__ = 'store', 'channel', 'periodts'
+
+	def __init__(self, store, channel, period, minint=None, maxint=None, result_limit=None):
+		BaseChannelData.__init__(self, period, minint, maxint, result_limit)
+		self.store = store
+		self.channel = channel
+		# start of the window of the queries, set by update_window()
+		self.periodts = None
+
+	def __len__(self):
+		return self.store.query('SELECT COUNT(*) FROM counts WHERE channel = ?', (self.channel,))[0][0]
+
+	def oldest(self):
+		return self.store.query('SELECT MIN(timestamp) FROM counts WHERE channel = ?', (self.channel,))[0][0]
+
+	def rows(self):
+		return self.store.query(
+			'SELECT user, word, timestamp FROM counts WHERE channel = ? ORDER BY timestamp', (self.channel,))
+
+	def dump(self):
+		return self.copy().dump()
+
+	def copy(self):
+		return ChannelData(self.period, self.minint, self.maxint, self.result_limit, Counts(self.rows()))
+
+	def snapshot(self, channel):
+		return self.copy().snapshot(channel)
+
+	def add(self, user, word, timestamp):
+		self.version += 1
+		self.store.add(self.channel, user, word, timestamp)
+
+	def update_window(self, periodts):
+		self.periodts = periodts
+
+	def count_words(self, words):
+		words = list(words)
+		counts = dict.fromkeys(words, 0)
+		counts.update(self.store.query(
+			'SELECT word, COUNT(*) FROM counts WHERE channel = ? AND timestamp >= ? AND word IN (%s) '
+			'GROUP BY word' % ', '.join('?' * len(words)),
+			[self.channel, self.periodts] + words))
+		return counts
+
+	def top(self, limit, condition=''):
+		if limit is not None and limit <= 0:
+			# (SQLite takes a negative LIMIT as no limit)
+			found = self.store.query(
+				'SELECT 1 FROM counts WHERE channel = ? AND timestamp >= ? %s LIMIT 1' % condition,
+				(self.channel, self.periodts))
+			return [] if found else None
+
+		# the BINARY collation orders UTF-8 like Python orders str
+		return self.store.query(
+			'SELECT word, COUNT(*) AS count FROM counts WHERE channel = ? AND timestamp >= ? %s '
+			'GROUP BY word ORDER BY count DESC, word LIMIT ?' % condition,
+			(self.channel, self.periodts, -1 if limit is None else limit)) or None
+
+	def top1(self, limit):
+		return self.top(limit, 'AND length(word) = 1')
+
+	def count_ints(self, minint, maxint):
+		return dict(self.store.query(
+			'SELECT num, COUNT(DISTINCT user) FROM counts WHERE channel = ? AND timestamp >= ? '
+			'AND num BETWEEN ? AND ? GROUP BY num',
+			(self.channel, self.periodts,
+			 sqlite_bound(minint, SQLITE_MININT), sqlite_bound(maxint, SQLITE_MAXINT))))
+
+	def gc(self, periodts):
+		return self.store.modify('DELETE FROM counts WHERE channel = ? AND timestamp < ?', (self.channel, periodts))
+
+	def clear(self):
+		self.version += 1
+		return self.store.modify('DELETE FROM counts WHERE channel = ?', (self.channel,))
+
+	def window(self, periodts):
+		# the queries of a window are the same with another start, they
+		# only read the rows of the window through the timestamp index
+		window = SqliteChannelData(self.store, self.channel, self.period)
+		window.periodts = periodts
+		return window
+
+	def drop(self):
+		self.store.modify('DELETE FROM counts WHERE channel = ?', (self.channel,))
+		self.store.modify('DELETE FROM channels WHERE channel = ?', (self.channel,))
+
+class ChannelDataMap(dict):
+	"""
+		channel -> ChannelData, that creates missing channels like a
+		defaultdict. The channels of a loaded SnapshotFile are restored on
+		first access or by restore_slices() through restore(channel,
+		snapshot), a generator that yields between slices of the rows and
+		stores the ChannelData at its end. Until then they are only "in" the
+		map, get(), iteration and items() only see restored channels.
+	"""
+	__slots__ = 'make', 'restore', 'snapshot', 'restoring'
+
+	def __init__(self, make, restore, snapshot=None):
+		dict.__init__(self)
+		self.make = make
+		self.restore = restore
+		self.snapshot = snapshot if snapshot else None
+		# (channel, generator) of the partly restored channel
+		self.restoring = None
+
+	def __missing__(self, channel):
+		snapshot = self.snapshot
+		if snapshot is not None and channel in snapshot:
+			self.restore_slices(channel)
+			return dict.__getitem__(self, channel)
+		data = self[channel] = self.make(channel)
+		return data
+
+	def restore_slices(self, channel, deadline=None):
+		"""
+			Restore the channel of the snapshot until the perf_counter()
+			deadline, None means completely. Returns whether it is restored,
+			if not the next call continues where this one stopped.
+		"""
+		restoring = self.restoring
+		if restoring is not None and restoring[0] == channel:
+			slices = restoring[1]
+		else:
+			slices = self.restore(channel, self.snapshot.read(channel))
+			if deadline is not None:
+				self.restoring = (channel, slices)
+
+		for _ in slices:
+			if deadline is not None and perf_counter() >= deadline:
+				return False
+
+		if self.restoring is not None and self.restoring[0] == channel:
+			self.restoring = None
+		snapshot = self.snapshot
+		snapshot.discard(channel)
+		if not snapshot:
+			self.snapshot = None
+		return True
+
+	def __contains__(self, channel):
+		return dict.__contains__(self, channel) or (self.snapshot is not None and channel in self.snapshot)
+
+	def __delitem__(self, channel):
+		snapshot = self.snapshot
+		if snapshot is not None and channel in snapshot:
+			if self.restoring is not None and self.restoring[0] == channel:
+				self.restoring = None
+			snapshot.discard(channel)
+			if not snapshot:
+				self.snapshot = None
+		else:
+			dict.__delitem__(self, channel)
+
+	def unrestored(self):
+		"""
+			The channels that are not restored yet, smallest first.
+		"""
+		return self.snapshot.channels() if self.snapshot is not None else []
+
+	def raw_unrestored(self):
+		"""
+			(channel, segment) of all channels that are not restored yet.
+		"""
+		snapshot = self.snapshot
+		if snapshot is None:
+			return []
+		return [(channel, snapshot.raw(channel)) for channel in snapshot.channels()]
+
+class ExpiryWheel:
+	"""
+		Hashed timer wheel of channel expiry times. Each channel is in the
+		wheel at most once, at the tick when its oldest row falls out of the
+		channel's period. A tick is resolution seconds long and a channel that
+		is due further in the future than one revolution just stays in its
+		slot until a later revolution.
+	"""
+	__slots__ = 'resolution', 'slots', 'due', 'current'
+
+	def __init__(self, resolution, size=64):
+		self.resolution = resolution
+		self.slots = [set() for _ in range(size)]
+		self.due = {}
+		self.current = None
+
+	def __len__(self):
+		return len(self.due)
+
+	def __contains__(self, channel):
+		return channel in self.due
+
+	def schedule(self, channel, timestamp):
+		"""
+			Returns the time at which the channel is due.
+		"""
+		# round up, a channel must never be expired too early
+		tick = -(-timestamp // self.resolution)
+		old_tick = self.due.get(channel)
+		if old_tick is not None:
+			if old_tick == tick:
+				return tick * self.resolution
+			self.slots[old_tick % len(self.slots)].discard(channel)
+		self.due[channel] = tick
+		self.slots[tick % len(self.slots)].add(channel)
+		if self.current is None or tick < self.current:
+			self.current = tick
+		return tick * self.resolution
+
+	def next_due(self):
+		"""
+			Time of the next tick at which a channel is due, None if the wheel
+			is empty.
+		"""
+		due = self.due
+		if not due:
+			self.current = None
+			return None
+
+		size = len(self.slots)
+		start = self.current
+		for tick in range(start, start + size):
+			for channel in self.slots[tick % size]:
+				if due[channel] == tick:
+					self.current = tick
+					return tick * self.resolution
+
+		# all channels are due in later revolutions
+		self.current = min(due.values())
+		return self.current * self.resolution
+
+	def cancel(self, channel):
+		tick = self.due.pop(channel, None)
+		if tick is not None:
+			self.slots[tick % len(self.slots)].discard(channel)
+			if not self.due:
+				self.current = None
+
+	def pop_due(self, timestamp):
+		"""
+			Remove and return all channels that are due at the given time.
+		"""
+		due = self.due
+		if not due:
+			self.current = None
+			return []
+
+		now = timestamp // self.resolution
+		tick = self.current
+		if tick > now:
+			return []
+		# after one revolution every slot has been visited
+		end = min(now, tick + len(self.slots) - 1)
+		channels = []
+		while tick <= end:
+			slot = self.slots[tick % len(self.slots)]
+			if slot:
+				for channel in list(slot):
+					if due[channel] <= now:
+						slot.remove(channel)
+						del due[channel]
+						channels.append(channel)
+			tick += 1
+
+		self.current = now + 1 if due else None
+		return channels
+
+class Command:
+	"""
+		A chat command: its method and everything on_pubmsg and !help need
+		to know about it, computed once per class instead of per message.
+		An alias is its own Command with the name it is called by.
+	"""
+	__slots__ = 'name', 'function', 'alias', 'min_argc', 'max_argc', 'usage', 'help'
+
+	def __init__(self, name, function, alias):
+		self.name = name
+		self.function = function
+		self.alias = alias
+
+		code = function.__code__
+		varnames = code.co_varnames
+		argc = code.co_argcount
+		min_argc = argc - len(function.__defaults__) if function.__defaults__ else argc
+		varargs = code.co_flags & 0x4
+
+		# without self and event
+		self.min_argc = min_argc - 2
+		self.max_argc = None if varargs else argc - 2
+
+		usage = ['Usage: !', name]
+		for i in range(2, min_argc):
+			usage.append(' ')
+			usage.append(varnames[i])
+
+		for i in range(min_argc, argc):
+			usage.append(' [')
+			usage.append(varnames[i])
+			usage.append(']')
+
+		if varargs:
+			usage.append(' [')
+			usage.append(varnames[argc])
+			usage.append('...]')
+		self.usage = ''.join(usage)
+
+		help = []
+		doc = function.__doc__
+		if doc:
+			doc = doc.lstrip('\n').rstrip().split('\n')
+			first = doc[0]
+			indent = first[:len(first) - len(first.lstrip())]
+			indent_len = len(indent)
+			for line in doc:
+				if line.startswith(indent):
+					line = line[indent_len:]
+				help.append(line)
+		self.help = tuple(help)
+
+def command_table(cls, prefix):
+	"""
+		name -> Command of all methods of cls whose names start with prefix.
+	"""
+	commands = {}
+	for attr in dir(cls):
+		if attr.startswith(prefix):
+			function = getattr(cls, attr)
+			name = attr[len(prefix):]
+			# an alias is the same function under another name
+			commands[name] = Command(name, function, function.__name__ != attr)
+	return commands
 
 class CounterBot(irc.bot.SingleServerIRCBot):
 	__slots__ = ('home_channel', 'period', 'gcinterval', 'admins', 'ignored_users',
 	             'channel_data', 'join_channels', 'max_message_length',
-	             'default_minint', 'default_maxint', 'default_result_limit')
+	             'default_minint', 'default_maxint', 'default_result_limit',
+	             'compact_counts', 'dedup_counts', 'expiry', 'gc_at', 'tokenizer',
+	             'collapse_replies', 'cache_hits', 'cache_misses', 'collapsed_replies',
+	             'journal', 'journal_sequence', 'statefile', 'checkpoint_interval', 'store',
+	             'handoff', 'handoff_server', 'handoff_receiver', 'handed_off',
+	             'shards', 'coordinator', 'message_count', 'send_queue', 'privmsg_prefixes',
+	             'ingest_interval', 'ingest_buffers', 'ingest_pending', 'ingest_scheduled',
+	             'tokenizer_pool', 'query_pool')
+
+	# name -> Command of the cmd_ methods, and in the home channel also of
+	# the home_cmd_ methods. Built by register_commands() for every class.
+	channel_commands = {}
+	home_commands = {}
+	# for !commands
+	channel_command_list = ''
+	home_command_list = ''
+
+	def __init_subclass__(cls, **kwargs):
+		super().__init_subclass__(**kwargs)
+		cls.register_commands()
+
+	@classmethod
+	def register_commands(cls):
+		channel_commands = command_table(cls, 'cmd_')
+		home_only = command_table(cls, 'home_cmd_')
+		home_commands = dict(channel_commands)
+		home_commands.update(home_only)
+
+		cls.channel_commands = channel_commands
+		cls.home_commands = home_commands
+		cls.channel_command_list = ', '.join(sorted('!' + name for name, cmd in channel_commands.items() if not cmd.alias))
+		cls.home_command_list = ', '.join(sorted('!' + name for name, cmd in home_only.items() if not cmd.alias))
 
 	def __init__(self, home_channel, default_period, gcinterval, max_message_length,
 		         default_minint, default_maxint, default_result_limit, admins,
 		         ignored_users, nickname, channels, password=None,
-		         server='irc.twitch.tv', port=6667):
+		         server='irc.twitch.tv', port=6667, compact_counts=False, dedup_counts=False,
+		         message_cache_size=4096, collapse_replies=False, ingest_interval=0):
 		irc.bot.SingleServerIRCBot.__init__(self, [(server, port, password)], nickname, nickname)
 		self.home_channel = normalize_channel(home_channel) if home_channel else None
 		self.default_period = default_period
@@ -142,29 +1661,430 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		self.default_minint = default_minint
 		self.default_maxint = default_maxint
 		self.default_result_limit = default_result_limit
+		self.compact_counts = compact_counts
+		self.dedup_counts = dedup_counts
+		self.tokenizer = Tokenizer(message_cache_size)
+		self.collapse_replies = collapse_replies
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self.collapsed_replies = 0
 		self.admins = set(admin.lower() for admin in admins)
 		self.ignored_users = set(user.lower() for user in ignored_users)
-		self.channel_data = defaultdict(self.make_channel_data)
+		self.channel_data = ChannelDataMap(self.make_channel_data, self.restore_channel_slices)
 		self.joined_channels = set()
 		self.set_join_channels(channels)
-		self.gc_scheduled = False
-		self.schedule_gc_if_needed()
-
-	def make_channel_data(self):
-		return ChannelData(self.default_period, self.default_minint, self.default_maxint, self.default_result_limit)
-
-	def schedule_gc_if_needed(self):
-		if not self.gc_scheduled:
-			needed = False
-			for data in self.channel_data.values():
-				if data.counts:
-					needed = True
-					break
-			self.schedule_gc()
+		self.expiry = ExpiryWheel(gcinterval)
+		# time of the scheduled run_gc
+		self.gc_at = None
+		self.journal = None
+		# first journal segment not included in the loaded state
+		self.journal_sequence = 0
+		self.statefile = None
+		self.checkpoint_interval = None
+		self.store = None
+		# sender while handing off to a new process
+		self.handoff = None
+		self.handoff_server = None
+		# receiver while taking over from an old process
+		self.handoff_receiver = None
+		self.handed_off = False
+		# ShardSet of the coordinator, Coordinator of a shard worker
+		self.shards = None
+		self.coordinator = None
+		# counted messages since the last load report
+		self.message_count = 0
+		self.send_queue = None
+		# channel -> (b'PRIVMSG #channel :', max. chunk length)
+		self.privmsg_prefixes = {}
+		# with ingest_interval chat messages are buffered per channel as
+		# (user, message) and counted in batches
+		self.ingest_interval = ingest_interval
+		self.ingest_buffers = {}
+		self.ingest_pending = 0
+		self.ingest_scheduled = False
+		self.tokenizer_pool = None
+		self.query_pool = None
+
+	def now(self):
+		return timegm(gmtime())
+
+	def make_channel_data(self, channel):
+		if self.store is not None:
+			return SqliteChannelData(self.store, channel, self.default_period, self.default_minint,
+				self.default_maxint, self.default_result_limit)
+		return ChannelData(self.default_period, self.default_minint, self.default_maxint, self.default_result_limit,
+			self.make_counts())
+
+	def make_counts(self):
+		if self.dedup_counts:
+			return CompactDedupCounts() if self.compact_counts else DedupCounts()
+		else:
+			return CompactCounts() if self.compact_counts else Counts()
+
+	def schedule_expiry(self, channel):
+		"""
+			(Re-)schedule the expiry of the channel for when its oldest row
+			falls out of the channel's period.
+		"""
+		data = self.channel_data.get(channel)
+		oldest = data.oldest() if data is not None else None
+		if oldest is None:
+			self.expiry.cancel(channel)
+		else:
+			self.schedule_gc(self.expiry.schedule(channel, oldest + data.period + 1))
+
+	def schedule_all_expiries(self):
+		for channel in self.channel_data:
+			self.schedule_expiry(channel)
+
+	def schedule_gc(self, at):
+		"""
+			Run run_gc at the given time, unless it already runs before that.
+		"""
+		if self.gc_at is not None and self.gc_at <= at:
+			return
+		self.gc_at = at
+		self.connection.execute_delayed(max(at - self.now(), 0), self.run_gc, (at,))
+
+	def set_gcinterval(self, gcinterval):
+		self.log('set_gcinterval', gcinterval)
+		self.gcinterval = gcinterval
+		self.expiry = ExpiryWheel(gcinterval)
+		self.schedule_all_expiries()
+
+	# Changes of the state, these are journaled and replayed by their name.
+
+	def add_words(self, channel, user, words, timestamp):
+		self.log('add_words', channel, user, words, timestamp)
+		data = self.channel_data[channel]
+		for word in words:
+			data.add(user, word, timestamp)
+
+		if channel not in self.expiry:
+			self.schedule_expiry(channel)
+
+	def add_messages(self, channel, messages, timestamp):
+		"""
+			Add the words of a batch of (user, words) messages.
+		"""
+		self.log('add_messages', channel, messages, timestamp)
+		add = self.channel_data[channel].add
+		for user, words in messages:
+			for word in words:
+				add(user, word, timestamp)
+
+		if channel not in self.expiry:
+			self.schedule_expiry(channel)
+
+	def set_period(self, channel, period):
+		self.log('set_period', channel, period)
+		self.channel_data[channel].period = period
+		self.schedule_expiry(channel)
+
+	def set_minint(self, channel, minint):
+		self.log('set_minint', channel, minint)
+		self.channel_data[channel].minint = minint
+
+	def set_maxint(self, channel, maxint):
+		self.log('set_maxint', channel, maxint)
+		self.channel_data[channel].maxint = maxint
+
+	def set_result_limit(self, channel, result_limit):
+		self.log('set_result_limit', channel, result_limit)
+		self.channel_data[channel].result_limit = result_limit
+
+	def clear_counts(self, channel):
+		self.log('clear_counts', channel)
+		return self.channel_data[channel].clear()
+
+	def join_channel(self, channel):
+		self.log('join_channel', channel)
+		if channel != self.home_channel and channel not in self.join_channels:
+			self.join_channels.append(channel)
+
+		# otherwise it is joined on welcome
+		if self.connection.is_connected():
+			self.do_join(channel)
+
+	def part_channel(self, channel):
+		self.log('part_channel', channel)
+		if channel in self.join_channels:
+			self.join_channels.remove(channel)
+
+		if self.connection.is_connected():
+			self.do_part(channel)
+		else:
+			self.drop_channel(channel)
+			self.joined_channels.discard(channel)
+			if self.shards is not None:
+				self.shards.part(channel)
+
+		if self.coordinator is not None:
+			self.coordinator.send(('parted', channel))
+
+	def drop_channel(self, channel):
+		buffer = self.ingest_buffers.pop(channel, None)
+		if buffer is not None:
+			self.ingest_pending -= len(buffer)
+		if self.tokenizer_pool is not None:
+			# or they would recreate the channel when they come back
+			self.tokenizer_pool.discard(channel)
+		data = self.channel_data.get(channel)
+		if data is not None:
+			data.drop()
+		if channel in self.channel_data:
+			del self.channel_data[channel]
+		self.expiry.cancel(channel)
+
+	def log(self, *record):
+		if self.journal is not None:
+			self.journal.append(record)
+		if self.handoff is not None:
+			self.handoff.append(record)
+
+	def replay(self, record):
+		method = record[0]
+		if method not in JOURNALED:
+			raise ValueError('illegal journal record: %r' % (record,))
+		getattr(self, method)(*record[1:])
+
+	def open_journal(self, statefile, sync_interval=1, checkpoint_interval=300, replay=True):
+		"""
+			Replay the journal segments that are newer than the loaded state
+			and journal all further changes into a new segment. Every
+			checkpoint_interval seconds the state is written to statefile.
+			With replay=False the state already includes all segments (it
+			was handed off), they are kept until a checkpoint is written
+			right away.
+		"""
+		prefix = statefile + '.journal'
+		sequence = self.journal_sequence
+		records = 0
+		for segment, path in list_segments(prefix):
+			if not replay:
+				sequence = max(sequence, segment + 1)
+			elif segment < sequence:
+				# already in the state, but the checkpoint didn't get to delete it
+				os.remove(path)
+			else:
+				for record in read_segment(path):
+					self.replay(record)
+					records += 1
+				sequence = segment + 1
+
+		if records:
+			print('Replayed %d journal records.' % records)
+
+		self.statefile = statefile
+		self.checkpoint_interval = checkpoint_interval
+		self.journal = Journal(prefix, sequence, sync_interval)
+		self.connection.execute_delayed(checkpoint_interval if replay else 0, self.checkpoint)
+
+	def open_database(self, path):
+		"""
+			Keep the counts and settings in an SQLite database instead of in
+			memory and load the state stored there.
+		"""
+		store = self.store = SqliteStore(path)
+		settings = store.load_settings()
+		if settings is not None:
+			self.load(settings)
+
+		channel_data = ChannelDataMap(self.make_channel_data, self.restore_channel_slices)
+		for channel, period, minint, maxint, result_limit in store.channels():
+			channel_data[channel] = SqliteChannelData(store, channel, period, minint, maxint, result_limit)
+		self.channel_data = channel_data
+		self.schedule_all_expiries()
+		self.connection.execute_delayed(SQLITE_SAVE_INTERVAL, self.save_database)
+
+	def save_database(self):
+		"""
+			Write pending rows and the settings. Runs every SQLITE_SAVE_INTERVAL seconds.
+		"""
+		if self.store is None:
+			return
+
+		try:
+			self.flush_ingest()
+			self.store.save(self.snapshot_settings(), self.channel_data.items())
+		finally:
+			self.connection.execute_delayed(SQLITE_SAVE_INTERVAL, self.save_database)
+
+	def close_database(self):
+		if self.store is not None:
+			self.flush_ingest()
+			self.store.save(self.snapshot_settings(), self.channel_data.items())
+			self.store.close()
+			self.store = None
+
+	def close_journal(self):
+		if self.journal is not None:
+			self.journal_sequence = self.journal.close()
+			self.journal = None
+
+	def checkpoint(self):
+		"""
+			Write the state to the state file in a background thread. Only
+			copying the rows is done here.
+		"""
+		if self.journal is None:
+			return
+
+		settings, channels, raw_channels = self.copy_state()
+		statefile = self.statefile
+
+		def write(sequence):
+			settings['journal_sequence'] = sequence
+			write_file(statefile, lambda fp: write_snapshot(fp, settings,
+				(data.snapshot(channel) for channel, data in channels), raw_channels))
+
+		self.journal.checkpoint(write)
+		self.connection.execute_delayed(self.checkpoint_interval, self.checkpoint)
 
-	def schedule_gc(self):
-		self.connection.execute_delayed(self.gcinterval, self.run_gc)
-		self.gc_scheduled = True
+	def copy_state(self):
+		"""
+			Settings, (channel, ChannelData) copies and raw unrestored channels,
+			for writing a snapshot in another thread.
+		"""
+		self.flush_ingest()
+		settings = self.snapshot_settings()
+		channels = [(channel, data.copy()) for channel, data in self.channel_data.items()]
+		return settings, channels, self.channel_data.raw_unrestored()
+
+	def serve_handoff(self, path):
+		"""
+			Listen on the Unix domain socket path for a new process to hand
+			the state off to.
+		"""
+		self.handoff_server = HandoffServer(path, lambda sock: self.send_handoff(path, sock))
+
+	def send_handoff(self, path, sock):
+		"""
+			Runs in the thread of the connection of the new process. Sends the
+			state and forwards all changes until the new process has joined
+			all channels, then exits.
+		"""
+		with self.reactor.mutex:
+			settings, channels, raw_channels = self.copy_state()
+			sender = self.handoff = HandoffSender(sock)
+		print('Handing off state to a new process...')
+
+		def write_state(fp):
+			write_snapshot(fp, settings, (data.snapshot(channel) for channel, data in channels),
+				raw_channels, index=False)
+
+		def finish():
+			with self.reactor.mutex:
+				self.handoff = None
+				self.handed_off = True
+				self.close_journal()
+				return self.journal_sequence
+
+		if sender.run(write_state, finish):
+			print('Handed off state, exiting.')
+			with self.reactor.mutex:
+				self.connection.execute_delayed(0, lambda: self.die('%s is restarting.' % self.connection.get_nickname()))
+		else:
+			print('Handoff failed, keep running.', file=sys.stderr)
+			with self.reactor.mutex:
+				self.handoff = None
+				self.serve_handoff(path)
+
+	def receive_handoff(self, path, take_over):
+		"""
+			Load the state of the process listening on path, if there is one.
+			The forwarded changes are replayed after the welcome. take_over()
+			is called with the reactor locked once the old process is gone.
+		"""
+		sock = connect_handoff(path)
+		if sock is None:
+			return False
+
+		print('Receiving state from the running process...')
+
+		def replay(record):
+			with self.reactor.mutex:
+				self.replay(record)
+
+		def finish(sequence):
+			with self.reactor.mutex:
+				self.handoff_receiver = None
+				if sequence is not None:
+					self.journal_sequence = sequence
+				print('Took over from the old process.')
+				take_over()
+
+		receiver = HandoffReceiver(sock, replay, finish)
+		try:
+			self.load_snapshot(receiver.fp)
+		except Exception:
+			receiver.close()
+			raise
+		self.handoff_receiver = receiver
+		return True
+
+	def handoff_joined(self):
+		if self.handoff_receiver is not None:
+			self.handoff_receiver.done()
+
+	def close_handoff(self):
+		if self.handoff_server is not None:
+			self.handoff_server.close()
+			self.handoff_server = None
+		if self.handoff_receiver is not None:
+			self.handoff_receiver.close()
+			self.handoff_receiver = None
+
+	def start_shards(self, count, run_worker):
+		"""
+			Fork count worker processes, that run run_worker(index, conn),
+			and assign all channels but the home channel to them.
+		"""
+		self.shards = ShardSet(count, run_worker, self.reactor.mutex, self.part_channel)
+
+	def close_shards(self):
+		if self.shards is not None:
+			self.shards.close()
+			self.shards = None
+
+	def serve_coordinator(self, conn):
+		"""
+			Run as a shard worker, which joins and parts the channels the
+			coordinator at the other end of conn tells it to.
+		"""
+		self.set_join_channels([])
+		self.coordinator = Coordinator(conn, self.reactor.mutex, self.handle_coordinator,
+			# the same as SIGTERM, which the reactor thread handles
+			lambda: os.kill(os.getpid(), signal.SIGTERM))
+		self.connection.execute_delayed(SHARD_REPORT_INTERVAL, self.report_load)
+
+	def handle_coordinator(self, message):
+		command = message[0]
+		if command == 'join':
+			channel = message[1]
+			if channel not in self.join_channels:
+				self.join_channel(channel)
+		elif command == 'part':
+			channel = message[1]
+			if channel in self.join_channels or channel in self.joined_channels:
+				self.part_channel(channel)
+		elif command == 'shutdown':
+			os.kill(os.getpid(), signal.SIGTERM)
+		else:
+			raise ValueError('illegal coordinator message: %r' % (message,))
+
+	def report_load(self):
+		if self.coordinator is None:
+			return
+
+		self.coordinator.send(('load', {
+			'pid': os.getpid(),
+			'channels': len(self.joined_channels),
+			'rows': sum(len(data) for data in self.channel_data.values()),
+			'messages_per_second': self.message_count / SHARD_REPORT_INTERVAL,
+		}))
+		self.message_count = 0
+		self.connection.execute_delayed(SHARD_REPORT_INTERVAL, self.report_load)
 
 	def set_join_channels(self, channels):
 		channels = OrderedDict((normalize_channel(channel), True) for channel in channels)
@@ -172,35 +2092,36 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 			del channels[self.home_channel]
 		self.join_channels = list(channels)
 
-	def run_gc(self):
-		self.gc_scheduled = False
-		timestamp = timegm(gmtime())
-		delchannels = []
-		for channel in self.channel_data:
-			if channel not in self.joined_channels:
-				delchannels.append(channel)
+	def run_gc(self, at=None):
+		"""
+			Expire the rows of all channels that are due. Only runs while there
+			are channels with counts, so it is idle for channels without traffic.
+		"""
+		if at is not None and at != self.gc_at:
+			# superseded by a run for an earlier tick
+			return
+		self.gc_at = None
+		timestamp = self.now()
 
 		rowcount = 0
-		for channel in delchannels:
-			rowcount += len(self.channel_data[channel].counts)
-			del self.channel_data[channel]
-
-		needed = False
-		for data in self.channel_data.values():
-			periodts = timestamp - data.period
-			index = data.find_first_non_gc_count(periodts)
-
-			if index > 0:
-				del data.counts[:index]
-				rowcount += index
-
-			if data.counts:
-				needed = True
+		for channel in self.expiry.pop_due(timestamp):
+			data = self.channel_data.get(channel)
+			if data is None:
+				continue
+
+			if channel not in self.joined_channels and channel not in self.join_channels:
+				rowcount += len(data)
+				self.drop_channel(channel)
+			else:
+				rowcount += data.gc(timestamp - data.period)
+				self.schedule_expiry(channel)
 
-		print('gc: Deleted %d rows.' % rowcount if rowcount != 1 else 'gc: Deleted 1 row.')
+		if rowcount:
+			print('gc: Deleted %d rows.' % rowcount if rowcount != 1 else 'gc: Deleted 1 row.')
 
-		if needed:
-			self.schedule_gc()
+		at = self.expiry.next_due()
+		if at is not None:
+			self.schedule_gc(at)
 
 	def on_welcome(self, connection, event):
 		if self.home_channel is not None:
@@ -214,17 +2135,48 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		if self.home_channel is not None:
 			self.chunked_privmsg(self.home_channel, "%s booted!" % self.connection.get_nickname())
 
+		if self.channel_data.snapshot is not None:
+			self.restore_step()
+
+		receiver = self.handoff_receiver
+		if receiver is not None and receiver.thread is None:
+			receiver.start()
+			self.connection.execute_delayed(HANDOFF_JOIN_TIMEOUT, self.handoff_joined)
+
+	def on_join(self, connection, event):
+		if self.handoff_receiver is not None and event.source.nick == connection.get_nickname():
+			channels = self.channels
+			if (self.home_channel is None or self.home_channel in channels) and \
+					all(channel in channels for channel in self.join_channels):
+				self.handoff_joined()
+
 	def do_join(self, channel):
+		if self.shards is not None and channel != self.home_channel:
+			shard = self.shards.join(channel)
+			if self.home_channel is not None:
+				if shard is None:
+					self.chunked_privmsg(self.home_channel, "No shard left to join %s." % channel)
+				else:
+					self.chunked_privmsg(self.home_channel, "Joined to %s (shard %d)." % (channel, shard.index))
+			return
+
 		self.connection.join(channel)
 		self.joined_channels.add(channel)
-		self.chunked_privmsg(self.home_channel or channel, "Joined to %s." % channel)
+		# the coordinator reports joins of shards
+		if self.coordinator is None:
+			self.chunked_privmsg(self.home_channel or channel, "Joined to %s." % channel)
 
 	def do_part(self, channel):
+		if self.shards is not None and channel != self.home_channel:
+			self.shards.part(channel)
+			if self.home_channel is not None:
+				self.chunked_privmsg(self.home_channel, "Parted from %s." % channel)
+			return
+
 		self.connection.part(channel)
 
 		# delete data immediately, don't trust what the IRC server says
-		if channel in self.channel_data:
-			del self.channel_data[channel]
+		self.drop_channel(channel)
 
 		if channel in self.joined_channels:
 			self.joined_channels.remove(channel)
@@ -248,59 +2200,135 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		message = event.arguments[0]
 
 		if message.startswith("!"):
-			command, *args = message.rstrip().split()
+			command, *rest = message.split(None, 1)
 			command = command[1:]
-			if channel == self.home_channel:
-				method = 'home_cmd_'+command
-				if not hasattr(self, method):
-					method = 'cmd_'+command
-			else:
-				method = 'cmd_'+command
-
-			if hasattr(self, method):
+			# most commands in a busy channel are for other bots
+			cmd = (self.home_commands if channel == self.home_channel else self.channel_commands).get(command)
+			if cmd is not None:
+				# count what was said before the command
+				if self.ingest_interval:
+					self.flush_channel_ingest(channel)
 				try:
-					cmd = getattr(self, method)
-
-					min_argc = max_argc = cmd.__code__.co_argcount - 2
-					if cmd.__defaults__:
-						min_argc -= len(cmd.__defaults__)
-					if cmd.__code__.co_flags & 0x4:
-						max_argc = None
-
+					args = rest[0].split() if rest else ()
 					argc = len(args)
+					max_argc = cmd.max_argc
 					if max_argc is not None and argc > max_argc:
 						self.answer(event,
 							'@%s: Too many arguments. !%s takes no more than %d argument(s).' %
 							(sender, command, max_argc))
 
-					elif argc < min_argc:
+					elif argc < cmd.min_argc:
 						self.answer(event,
 							'@%s: Not enough arguments. !%s takes at least %d argument(s).' %
-							(sender, command, min_argc))
+							(sender, command, cmd.min_argc))
 
 					else:
-						cmd(event, *args)
+						cmd.function(self, event, *args)
 
 				except Exception as exc:
 					if isinstance(exc, EXIT_EXCS):
 						raise
 
 					traceback.print_exc()
+					self.report_error(event, exc)
 
-					self.chunked_privmsg(self.home_channel,
-						'Error processing command !%s in channel %s performed by %s: %s' %
-						(command, channel, sender, exc))
-
 		else:
-			timestamp = timegm(gmtime())
-			words = WORDS.findall(message)
+			self.message_count += 1
+			if self.ingest_interval:
+				self.buffer_message(channel, sender, message)
+			else:
+				words = self.tokenizer.tokenize(message)
+				if words:
+					self.add_words(channel, sender, words, self.now())
+
+	def report_error(self, event, exc):
+		self.chunked_privmsg(self.home_channel,
+			'Error processing command %s in channel %s performed by %s: %s' %
+			(event.arguments[0].split()[0], event.target, event.source.nick, exc))
+
+	def buffer_message(self, channel, user, message):
+		buffer = self.ingest_buffers.get(channel)
+		if buffer is None:
+			buffer = self.ingest_buffers[channel] = []
+		buffer.append((user, message))
+		self.ingest_pending += 1
+		if self.ingest_pending >= INGEST_BATCH_SIZE:
+			self.flush_ingest(wait=False)
+		elif not self.ingest_scheduled:
+			self.schedule_ingest()
+
+	def schedule_ingest(self):
+		self.ingest_scheduled = True
+		self.connection.execute_delayed(self.ingest_interval, self.run_ingest)
+
+	def run_ingest(self):
+		self.ingest_scheduled = False
+		self.flush_ingest(wait=False)
+		if self.tokenizer_pool is not None:
+			self.count_tokenized()
+			# poll until all batches are back
+			if self.tokenizer_pool and not self.ingest_scheduled:
+				self.schedule_ingest()
+
+	def flush_ingest(self, wait=True):
+		"""
+			Count all buffered messages, with one timestamp. With a tokenizer
+			pool they are counted when they come back from it, unless wait is
+			true, then everything is counted right away.
+		"""
+		pool = self.tokenizer_pool
+		if pool is not None and wait:
+			self.count_tokenized(wait=True)
+		if not self.ingest_pending:
+			return
+		buffers = self.ingest_buffers
+		self.ingest_buffers = {}
+		self.ingest_pending = 0
+		timestamp = self.now()
+		if pool is None or wait:
+			for channel, buffer in buffers.items():
+				self.count_messages(channel, buffer, timestamp)
+		else:
+			for channel, buffer in buffers.items():
+				pool.submit(channel, buffer, timestamp)
+			if not self.ingest_scheduled:
+				self.schedule_ingest()
+
+	def flush_channel_ingest(self, channel):
+		if self.tokenizer_pool is not None:
+			self.count_tokenized(wait=True)
+		buffer = self.ingest_buffers.pop(channel, None)
+		if buffer is not None:
+			self.ingest_pending -= len(buffer)
+			self.count_messages(channel, buffer, self.now())
+
+	def count_tokenized(self, wait=False):
+		for channel, messages, timestamp in self.tokenizer_pool.done(wait):
+			if messages:
+				self.add_messages(channel, messages, timestamp)
+
+	def open_tokenizer_pool(self, processes):
+		"""
+			Tokenize the buffered messages in processes worker processes.
+			Needs ingest_interval.
+		"""
+		self.tokenizer_pool = TokenizerPool(processes, self.tokenizer.max_messages)
+
+	def close_tokenizer_pool(self):
+		if self.tokenizer_pool is not None:
+			self.flush_ingest()
+			self.tokenizer_pool.close()
+			self.tokenizer_pool = None
+
+	def count_messages(self, channel, buffer, timestamp):
+		tokenize = self.tokenizer.tokenize
+		messages = []
+		for user, message in buffer:
+			words = tokenize(message)
 			if words:
-				counts = self.channel_data[channel].counts
-				for word in words:
-					counts.append((sender, normalize(word), timestamp))
-
-				if not self.gc_scheduled:
-					self.schedule_gc()
+				messages.append((user, words))
+		if messages:
+			self.add_messages(channel, messages, timestamp)
 
 	def is_allowed(self, user, channel):
 		if user in self.admins:
@@ -330,7 +2358,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 				except ValueError as ex:
 					self.answer(event, "@%s: Illegal count period: %s" % (sender, time))
 				else:
-					data.period = seconds
+					self.set_period(channel, seconds)
 					self.answer(event, "@%s: Changed count period to %s" % (sender, format_time(data.period)))
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
@@ -339,104 +2367,93 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		"""
 			Count given words or if none given all words.
 			Every word is only counted once per user.
+			Count only the last seconds with e.g.: !count 30s words...
 		"""
-		timestamp = timegm(gmtime())
+		timestamp = self.now()
 		channel = event.target
 		data = self.channel_data[channel]
-		periodts = timestamp - data.period
-		channel_counts = data.counts
-		all_user_words = defaultdict(set)
+		window = parse_window(words[0]) if words else None
+		if window is not None:
+			words = words[1:]
+			window = self.count_window(data, window)
+		counted = lambda data: data.window(timestamp - window) if window is not None else data
 
 		if words:
-			word_counts = dict((normalize(word), 0) for word in words)
-			for user, word, timestamp in reversed(channel_counts):
-				if timestamp < periodts:
-					break
-
-				if word in word_counts:
-					user_words = all_user_words[user]
-					if word not in user_words:
-						word_counts[word] += 1
-						user_words.add(word)
-
-			# de-normalize counted words
-			word_counts = dict((word, word_counts[normalize(word)]) for word in words)
+			normalized = dict((word, normalize(word)) for word in words)
+			key = frozenset(normalized.values())
+			def report(event, counts):
+				# de-normalize counted words
+				word_counts = dict((word, counts[normalized[word]]) for word in words)
+				self.report_counts(event, word_counts, window)
+
+			self.query(event, data, ('count', key, window), timestamp, lambda data: counted(data).count_words(key), report)
 		else:
-			word_counts = defaultdict(int)
-			for user, word, timestamp in reversed(channel_counts):
-				if timestamp < periodts:
-					break
-
-				user_words = all_user_words[user]
-				if word not in user_words:
-					word_counts[word] += 1
-					user_words.add(word)
-
-		self.report_counts(event, word_counts)
+			result_limit = data.result_limit
+			self.query(event, data, ('count', result_limit, window), timestamp,
+				lambda data: counted(data).top(result_limit),
+				lambda event, counts: self.report_top_counts(event, counts, window))
 
-	def cmd_countint(self, event, minint=None, maxint=None):
+	def cmd_countint(self, event, window=None, minint=None, maxint=None):
 		"""
 			Count integer numbers.
 			Every number is only counted once per user.
+			Count only the last seconds with e.g.: !countint 30s
 		"""
-		timestamp = timegm(gmtime())
+		timestamp = self.now()
 		channel = event.target
 		data = self.channel_data[channel]
+		if window is not None and parse_window(window) is None:
+			# no window, just the bounds
+			if maxint is not None:
+				self.answer(event, "@%s: Illegal time window: %s" % (event.source.nick, window))
+				return
+			window, minint, maxint = None, window, minint
+		elif window is not None:
+			window = self.count_window(data, parse_window(window))
+
 		minint = parse_int_bound(minint) if minint is not None else data.minint
 		maxint = parse_int_bound(maxint) if maxint is not None else data.maxint
-		periodts = timestamp - data.period
-		channel_counts = data.counts
-		all_user_words = defaultdict(set)
-
-		word_counts = defaultdict(int)
-		for user, word, timestamp in reversed(channel_counts):
-			if timestamp < periodts:
-				break
-
-			try:
-				num = int(word, 10)
-			except ValueError:
-				pass
-			else:
-				user_words = all_user_words[user]
-				if minint is not None and num < minint:
-					pass
-				elif maxint is not None and num > maxint:
-					pass
-				elif num not in user_words:
-					word_counts[num] += 1
-					user_words.add(num)
+		result_limit = data.result_limit
+		def compute(counted):
+			if window is not None:
+				counted = counted.window(timestamp - window)
+			word_counts = counted.count_ints(minint, maxint)
+			return top_counts(word_counts.items(), result_limit) if word_counts else None
 
-		self.report_counts(event, word_counts)
+		self.query(event, data, ('countint', minint, maxint, result_limit, window), timestamp, compute,
+			lambda event, counts: self.report_top_counts(event, counts, window))
 
 	cmd_countinit = cmd_countint
 	cmd_intcount  = cmd_countint
 	cmd_initcount = cmd_countint
 
-	def cmd_count1(self, event):
+	def cmd_count1(self, event, window=None):
 		"""
 			Count all one-letter words.
 			Every word is only counted once per user.
+			Count only the last seconds with e.g.: !count1 30s
 		"""
-		timestamp = timegm(gmtime())
+		timestamp = self.now()
 		channel = event.target
 		data = self.channel_data[channel]
-		periodts = timestamp - data.period
-		channel_counts = data.counts
-		all_user_words = defaultdict(set)
-
-		word_counts = defaultdict(int)
-		for user, word, timestamp in reversed(channel_counts):
-			if timestamp < periodts:
-				break
-
-			if len(word) == 1:
-				user_words = all_user_words[user]
-				if not word in user_words:
-					word_counts[word] += 1
-					user_words.add(word)
-
-		self.report_counts(event, word_counts)
+		if window is not None:
+			seconds = parse_window(window)
+			if seconds is None:
+				self.answer(event, "@%s: Illegal time window: %s" % (event.source.nick, window))
+				return
+			window = self.count_window(data, seconds)
+
+		result_limit = data.result_limit
+		self.query(event, data, ('count1', result_limit, window), timestamp,
+			lambda data: (data.window(timestamp - window) if window is not None else data).top1(result_limit),
+			lambda event, counts: self.report_top_counts(event, counts, window))
+
+	def count_window(self, data, window):
+		"""
+			The window in seconds if it is shorter than the count period,
+			else None (only the rows of the period are kept).
+		"""
+		return window if window < data.period else None
 
 	def cmd_clearcount(self, event):
 		"""
@@ -445,9 +2462,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		sender = event.source.nick
 		channel = event.target
 		if self.is_allowed(sender, channel):
-			data = self.channel_data[channel]
-			rowcount = len(data.counts)
-			del data.counts[:]
+			rowcount = self.clear_counts(channel)
 			self.answer(event, 'Deleted %d rows.' % rowcount if rowcount != 1 else 'Deleted 1 row.')
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
@@ -462,7 +2477,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		if value is None:
 			self.answer(event, "@%s: !countint minimum is %s." % (sender, data.minint if data.minint is not None else 'unbounded'))
 		elif self.is_allowed(sender, channel):
-			data.minint = parse_int_bound(value)
+			self.set_minint(channel, parse_int_bound(value))
 			self.answer(event, "@%s: Changed !countint minimum to %s" % (sender, data.minint if data.minint is not None else 'unbounded'))
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
@@ -479,7 +2494,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		if value is None:
 			self.answer(event, "@%s: !countint maximum is %s." % (sender, data.maxint if data.maxint is not None else 'unbounded'))
 		elif self.is_allowed(sender, channel):
-			data.maxint = parse_int_bound(value)
+			self.set_maxint(channel, parse_int_bound(value))
 			self.answer(event, "@%s: Changed !countint maximum to %s" % (sender, data.maxint if data.maxint is not None else 'unbounded'))
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
@@ -496,7 +2511,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		if value is None:
 			self.answer(event, "@%s: Count result list entry limit is %s." % (sender, data.result_limit if data.result_limit is not None else 'unlimited'))
 		elif self.is_allowed(sender, channel):
-			data.result_limit = parse_int_bound(value)
+			self.set_result_limit(channel, parse_int_bound(value))
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
 
@@ -510,25 +2525,10 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		"""
 			Show the list of commands.
 		"""
-		channel_commands = []
-		home_commands = []
 		sender = event.source.nick
-		for name in dir(self):
-			if name.startswith('cmd_'):
-				if getattr(self, name).__name__ == name:
-					# otherwise its an alias
-					channel_commands.append('!'+name[4:])
-
-			elif name.startswith('home_cmd_'):
-				if getattr(self, name).__name__ == name:
-					# otherwise its an alias
-					home_commands.append('!'+name[9:])
-
-		channel_commands.sort()
-		home_commands.sort()
-		message = '@%s: Commands: %s' % (sender, ', '.join(channel_commands))
+		message = '@%s: Commands: %s' % (sender, self.channel_command_list)
 		if self.home_channel is not None:
-			message += ' %s-only commands: %s' % (self.home_channel, ', '.join(home_commands))
+			message += ' %s-only commands: %s' % (self.home_channel, self.home_command_list)
 		self.answer(event, message)
 
 	def home_cmd_help(self, event, command=None):
@@ -545,47 +2545,11 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 			if command.startswith('!'):
 				command = command[1:]
 
-			if channel == self.home_channel:
-				method = 'home_cmd_'+command
-				if not hasattr(self, method):
-					method = 'cmd_'+command
-			else:
-				method = 'cmd_'+command
-
-			if hasattr(self, method):
-				cmd = getattr(self, method)
-				doc = cmd.__doc__
-				usage = ['Usage: !', command]
-
-				min_argc = argc = cmd.__code__.co_argcount
-				if cmd.__defaults__:
-					min_argc -= len(cmd.__defaults__)
-
-				varnames = cmd.__code__.co_varnames
-				for i in range(2, min_argc):
-					usage.append(' ')
-					usage.append(varnames[i])
-
-				for i in range(min_argc, argc):
-					usage.append(' [')
-					usage.append(varnames[i])
-					usage.append(']')
-
-				if cmd.__code__.co_flags & 0x4:
-					usage.append(' [')
-					usage.append(varnames[argc])
-					usage.append('...]')
-
-				self.answer(event, ''.join(usage))
-				if doc:
-					doc = doc.lstrip('\n').rstrip().split('\n')
-					first = doc[0]
-					indent = first[:len(first) - len(first.lstrip())]
-					indent_len = len(indent)
-					for line in doc:
-						if line.startswith(indent):
-							line = line[indent_len:]
-						self.answer(event, line)
+			cmd = (self.home_commands if channel == self.home_channel else self.channel_commands).get(command)
+			if cmd is not None:
+				self.answer(event, cmd.usage)
+				for line in cmd.help:
+					self.answer(event, line)
 			else:
 				self.answer(event, "@%s: No such command !%s" % (sender, command))
 
@@ -596,7 +2560,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		channel = normalize_channel(channel)
 		sender = event.source.nick
 		if self.is_allowed(sender, channel):
-			self.do_join(channel)
+			self.join_channel(channel)
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
 
@@ -617,11 +2581,21 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 				except ValueError as ex:
 					self.answer(event, "@%s: Illegal gcinterval: %s" % (sender, value))
 				else:
-					self.gcinterval = seconds
+					self.set_gcinterval(seconds)
 					self.answer(event, "@%s: Changed gcinterval to %s" % (sender, format_time(self.gcinterval)))
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
 
+	def home_cmd_stats(self, event):
+		"""
+			Show cache statistics. WordCountBot-admin only.
+		"""
+		sender = event.source.nick
+		if self.is_allowed(sender, self.home_channel):
+			self.answer(event, 'Stats: ' + '; '.join(self.stats()))
+		else:
+			self.answer(event, "@%s: You don't have permissions to do that." % sender)
+
 	def home_cmd_leave(self, event, channel):
 		"""
 			Make WordCountBot leave the given channel. Only allowed for operators of the given channel.
@@ -632,7 +2606,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 			if channel == self.home_channel:
 				self.answer(event, "@%s: Cannot leave home channel." % sender)
 			else:
-				self.do_part(channel)
+				self.part_channel(channel)
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
 
@@ -642,93 +2616,294 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		"""
 		sender = event.source.nick
 		if self.is_allowed(sender, self.home_channel):
-			self.answer(event, 'Joined channels: ' + ', '.join(self.channels))
+			message = 'Joined channels: ' + ', '.join(self.channels)
+			if self.shards is not None:
+				message += '; ' + '; '.join(self.shard_loads())
+			self.answer(event, message)
 		else:
 			self.answer(event, "@%s: You don't have permissions to do that." % sender)
 
-	def report_counts(self, event, word_counts):
+	def shard_loads(self):
+		loads = []
+		for shard in self.shards.shards:
+			if not shard.alive:
+				loads.append('shard %d: dead' % shard.index)
+				continue
+			load = shard.load
+			loads.append('shard %d (%d channels, %d rows, %.1f msg/s): %s' % (
+				shard.index, len(shard.channels), load.get('rows', 0),
+				load.get('messages_per_second', 0), ', '.join(sorted(shard.channels))))
+		return loads
+
+	def query(self, event, data, key, timestamp, compute, report):
+		"""
+			Call report(event, result) with the (cached) result of
+			compute(counted), where counted are the channel's counts of the
+			window ending at timestamp. With query threads and the SQLite
+			storage compute() runs in a query thread on the rows committed
+			until now and report() is called later by the reactor.
+		"""
+		result = data.lookup(key, timestamp)
+		if result is not MISSING:
+			self.cache_hits += 1
+			report(event, result)
+			return
+
+		self.cache_misses += 1
+		stamp = data.cache_stamp
+		periodts = timestamp - data.period
+		data.update_window(periodts)
+		if self.query_pool is None or self.store is None:
+			result = compute(data)
+			data.cache_result(stamp, key, result)
+			report(event, result)
+			return
+
+		self.store.flush()
+		# the reactor moves the window of data for later commands while
+		# the thread runs, so the thread queries its own copy of it
+		future = self.query_pool.submit(compute, data.window(periodts))
+		future.add_done_callback(lambda future: self.call_in_reactor(
+			lambda: self.query_done(event, data, stamp, key, future, report)))
+
+	def query_done(self, event, data, stamp, key, future, report):
+		channel = event.target
+		if self.channel_data.get(channel) is not data:
+			# parted meanwhile
+			return
+		try:
+			result = future.result()
+			data.cache_result(stamp, key, result)
+			report(event, result)
+		except Exception as exc:
+			traceback.print_exc()
+			self.report_error(event, exc)
+
+	def call_in_reactor(self, function):
+		with self.reactor.mutex:
+			self.connection.execute_delayed(0, function)
+
+	def open_query_threads(self, threads):
+		"""
+			Run the count queries of the SQLite storage in threads threads.
+		"""
+		self.query_pool = ThreadPoolExecutor(threads)
+
+	def close_query_threads(self):
+		if self.query_pool is not None:
+			self.query_pool.shutdown()
+			self.query_pool = None
+
+	def stats(self):
+		return [
+			'channels: %d restored, %d not yet restored' % (
+				len(self.channel_data), len(self.channel_data.unrestored())),
+			'result cache: %d hits, %d misses, %d collapsed replies' % (
+				self.cache_hits, self.cache_misses, self.collapsed_replies),
+			'message cache: %d hits, %d misses' % (self.tokenizer.hits, self.tokenizer.misses),
+		] + ([self.send_queue.stats()] if self.send_queue is not None else [])
+
+	def report_counts(self, event, word_counts, window=None):
 		data = self.channel_data[event.target]
-		period = data.period
 		if word_counts:
-			result_limit = data.result_limit
-			counts = list(word_counts.items())
-			counts.sort(key=lambda item: (-item[1], item[0]))
-			if result_limit is not None and len(counts) > result_limit:
-				counts = counts[:result_limit]
-			self.answer(event, 'Word-counts within the last %s: %s' % (
-				format_time(period), ' — '.join('%s: %d' % item for item in counts)))
+			self.report_top_counts(event, top_counts(word_counts.items(), data.result_limit), window)
+		else:
+			self.report_top_counts(event, None, window)
+
+	def report_top_counts(self, event, counts, window=None):
+		data = self.channel_data[event.target]
+		period = window or data.period
+		if counts is not None:
+			message = 'Word-counts within the last %s: %s' % (
+				format_time(period), ' — '.join('%s: %d' % item for item in counts))
 		else:
-			self.answer(event, 'No words counted in the last %s.' % format_time(period))
+			message = 'No words counted in the last %s.' % format_time(period)
+
+		if self.collapse_replies:
+			# don't repeat the very same result for a burst of identical commands
+			reply = (data.cache_stamp, message)
+			if data.last_reply == reply:
+				self.collapsed_replies += 1
+				return
+			data.last_reply = reply
 
-	def answer(self, event, message):
+		# a queued result of the same command is replaced by this newer one
+		self.answer(event, message, ' '.join(event.arguments[0].split()))
+
+	def answer(self, event, message, key=None):
 		channel = event.target
+		if self.send_queue is not None:
+			priority = channel == self.home_channel and event.source.nick.lower() in self.admins
+			self.chunked_privmsg(channel, message, key, priority)
+			return
+
 		nick = self.connection.get_nickname()
 		if event.source.nick != nick or self.channels[channel].is_oper(nick):
 			self.chunked_privmsg(channel, message)
 		else:
 			self.connection.execute_delayed(1, lambda: self.chunked_privmsg(channel, message))
 
+	def open_send_queue(self, rate=20, mod_rate=100):
+		"""
+			Send messages through a SendQueue, which limits them to rate
+			messages per 30 seconds (mod_rate in channels where the bot is
+			operator).
+		"""
+		self.send_queue = SendQueue(self.send_lines, self.connection.execute_delayed, rate, mod_rate)
+
+	def is_mod(self, channel):
+		channel = self.channels.get(channel)
+		return channel is not None and channel.is_oper(self.connection.get_nickname())
+
+	def send_lines(self, lines):
+		try:
+			self._send_raw(lines[0] if len(lines) == 1 else b''.join(lines))
+		except ServerNotConnectedError:
+			print('Error: not connected, dropped message', file=sys.stderr)
+
 	def _send_raw(self, bytes):
 		if self.connection.socket is None:
 			raise ServerNotConnectedError("Not connected.")
 		try:
-			self.connection.socket.send(bytes)
+			self.connection.socket.sendall(bytes)
 		except socket.error:
 			self.connection.disconnect("Connection reset by peer.")
 
-	def chunked_privmsg(self, channel, message):
+	def chunked_privmsg(self, channel, message, key=None, priority=False):
 		print('%s: %s' % (channel, message))
+		lines = self.privmsg_lines(channel, message)
+		if self.send_queue is None:
+			# one write for all chunks
+			self._send_raw(lines[0] if len(lines) == 1 else b''.join(lines))
+		else:
+			self.send_queue.enqueue(channel, lines, self.is_mod(channel), key, priority)
+
+	def privmsg_lines(self, channel, message):
+		"""
+			The PRIVMSG lines of message, split into chunks of at most
+			max_message_length bytes at spaces if possible.
+		"""
+		prefix = self.privmsg_prefixes.get(channel)
+		if prefix is None:
+			prefix = self.privmsg_prefixes[channel] = self.privmsg_prefix(channel)
+		prefix, maxlen = prefix
+		return chunk_message(prefix, message.encode('utf-8'), maxlen)
+
+	def privmsg_prefix(self, channel):
+		prefix = b'PRIVMSG ' + channel.encode('utf-8') + b' :'
 		maxlen = self.max_message_length
-		channel_utf8 = channel.encode('utf-8')
 		if maxlen is not None:
-			maxlen -= len(channel_utf8) + 11 # len("PRIVMSG "+...+" "+...+"\r\n")
+			maxlen -= len(prefix) + 2 # len("PRIVMSG "+...+" :"+...+"\r\n")
 			if maxlen <= 0:
 				maxlen = 8
-		message_utf8 = message.encode('utf-8')
-		N = len(message_utf8)
-		if maxlen and N > maxlen:
-			index = 0
-			while index < N:
-				next_index = index + maxlen
-				if next_index >= N:
-					self._send_raw(b''.join((b'PRIVMSG ',channel_utf8,b' :',message_utf8[index:],b'\r\n')))
-					break
-
-				space_index = None
-				for i in range(next_index, index - 1, -1):
-					byte = message_utf8[i]
-					if byte == 32 or byte == 9:
-						space_index = i
-						break
-
-				if space_index is None:
-					# at least don't cut in the middle of a multi-byte sequence
-					while next_index > index:
-						byte = message_utf8[next_index]
-						if byte < 128 or byte >= 192:
-							break
-						next_index -= 1
-					chunk = message_utf8[index:next_index]
-				else:
-					chunk = message_utf8[index:space_index].rstrip()
-					next_index = space_index + 1
-
-				self._send_raw(b''.join((b'PRIVMSG ',channel_utf8,b' :',chunk,b'\r\n')))
-				index = next_index
-		else:
-			self._send_raw(b''.join((b'PRIVMSG ',channel_utf8,b' :',message_utf8,b'\r\n')))
+		return prefix, maxlen
 
 	def dump(self):
+		self.flush_ingest()
+		self.restore_all()
 		return {
 			'version': '1.0',
 			'channels': list(self.joined_channels),
 			'default_period': self.default_period,
-			'gcinterval': self.gcinterval,
+			'gc_resolution': self.gcinterval,
 			'channel_data': dict(
 				(channel, self.channel_data[channel].dump())
 				for channel in self.channel_data)
 		}
 
+	def snapshot_settings(self):
+		return {
+			'version': '1.0',
+			'channels': sorted(self.joined_channels.union(self.join_channels)),
+			'default_period': self.default_period,
+			'gc_resolution': self.gcinterval,
+			'default_minint': self.default_minint,
+			'default_maxint': self.default_maxint,
+			'default_result_limit': self.default_result_limit,
+			'journal_sequence': self.journal_sequence,
+		}
+
+	def dump_snapshot(self, fp):
+		"""
+			Write the same state as dump() in the binary snapshot format.
+		"""
+		self.flush_ingest()
+		channel_data = self.channel_data
+		write_snapshot(fp, self.snapshot_settings(),
+			(data.snapshot(channel) for channel, data in channel_data.items()),
+			channel_data.raw_unrestored())
+
+	def load_snapshot(self, fp):
+		"""
+			Load a snapshot. If it has an index the channels are only restored
+			when they are first used or by restore_step() in the background.
+		"""
+		# a stream (handoff) can only be read sequentially
+		snapshot = open_snapshot(fp) if fp.seekable() else None
+		if snapshot is not None:
+			settings = snapshot.settings
+		else:
+			settings, channels = read_snapshot(fp)
+		self.load(settings)
+		self.journal_sequence = int(settings.get('journal_sequence', 0))
+
+		self.channel_data = ChannelDataMap(self.make_channel_data, self.restore_channel_slices, snapshot)
+		if snapshot is None:
+			for channel_snapshot in channels:
+				self.restore_channel(channel_snapshot.channel, channel_snapshot)
+
+	def restore_channel(self, channel, snapshot):
+		for _ in self.restore_channel_slices(channel, snapshot):
+			pass
+		return self.channel_data[channel]
+
+	def restore_channel_slices(self, channel, snapshot):
+		"""
+			Restore the channel from its ChannelSnapshot, yields after every
+			RESTORE_SLICE_ROWS rows. The ChannelData is only stored after
+			the last slice, so a partly restored channel is never used.
+		"""
+		counts = self.make_counts()
+		timestamps = snapshot.timestamps
+		sizes = snapshot.sizes
+		start = 0
+		index = 0
+		while start < len(timestamps):
+			end = start
+			rows = 0
+			while end < len(timestamps) and rows < RESTORE_SLICE_ROWS:
+				rows += sizes[end]
+				end += 1
+			counts.load_columns(snapshot.users, snapshot.words, timestamps[start:end], sizes[start:end],
+				snapshot.user_ids[index:index + rows], snapshot.word_ids[index:index + rows])
+			start = end
+			index += rows
+			yield
+
+		self.channel_data[channel] = ChannelData(snapshot.period, snapshot.minint,
+			snapshot.maxint, snapshot.result_limit, counts)
+		self.schedule_expiry(channel)
+
+	def restore_step(self):
+		"""
+			Restore channels, smallest first, for at most RESTORE_BUDGET
+			seconds and then yield to the reactor until the next step. A
+			channel that takes longer is continued in the next step.
+		"""
+		channel_data = self.channel_data
+		deadline = perf_counter() + RESTORE_BUDGET
+		for channel in channel_data.unrestored():
+			if not channel_data.restore_slices(channel, deadline) or perf_counter() >= deadline:
+				break
+
+		if channel_data.snapshot is not None:
+			self.connection.execute_delayed(0, self.restore_step)
+
+	def restore_all(self):
+		channel_data = self.channel_data
+		for channel in channel_data.unrestored():
+			channel_data[channel]
+
 	def load(self, state):
 		version = state['version']
 		if version != '1.0':
@@ -742,11 +2917,14 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 		else:
 			default_period = self.default_period
 
-		if 'gcinterval' in state:
-			gcinterval = int(state['gcinterval'])
+		# 'gcinterval' of older states is the interval of the sweep over all
+		# channels the expiry wheel replaced (usually 600 seconds), as a wheel
+		# resolution it would expire rows that late, so it is ignored
+		if 'gc_resolution' in state:
+			gcinterval = int(state['gc_resolution'])
 			if gcinterval <= 0:
 				raise ValueError('illegal gcinterval: %r' % gcinterval)
-			self.gcinterval = gcinterval
+			self.set_gcinterval(gcinterval)
 
 		if 'default_minint' in state:
 			default_minint = state['default_minint']
@@ -768,14 +2946,14 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 			default_result_limit = state['default_result_limit']
 			if default_result_limit is not None:
 				default_result_limit = int(default_result_limit)
-			if default_result_limit < 1:
+			if default_result_limit is not None and default_result_limit < 1:
 				raise ValueError('illegal default_result_limit: %r' % default_result_limit)
 			self.default_result_limit = default_result_limit
 		else:
 			default_result_limit = self.default_result_limit
 
 		if 'channel_data' in state:
-			channel_data = defaultdict(self.make_channel_data)
+			channel_data = ChannelDataMap(self.make_channel_data, self.restore_channel_slices)
 			for channel, data in state['channel_data'].items():
 				period = data.get('period', default_period)
 				minint = data.get('minint', default_minint)
@@ -783,7 +2961,7 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 				result_limit = data.get('result_limit', default_result_limit)
 
 				rows = data.get('counts')
-				channel_counts = []
+				channel_counts = self.make_counts()
 				if rows:
 					for row in rows:
 						if type(row) not in ROW_TYPES or len(row) != 3:
@@ -794,10 +2972,11 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 						if type(user) is not str or type(word) is not str or type(timestamp) is not int:
 							raise ValueError('illegal counts-row for channel %s: %r' % (channel, row))
 
-						channel_counts.append((user, word, timestamp))
+						channel_counts.add(user, word, timestamp)
 
 				channel_data[channel] = ChannelData(period, minint, maxint, result_limit, channel_counts)
 			self.channel_data = channel_data
+			self.schedule_all_expiries()
 
 		if 'channels' in state:
 			self.set_join_channels(state['channels'])
@@ -811,6 +2990,32 @@ class CounterBot(irc.bot.SingleServerIRCBot):
 			if self.home_channel is not None:
 				if self.connection.socket:
 					self.chunked_privmsg(self.home_channel, '%s is shutting down.' % self.connection.get_nickname())
+			if self.send_queue is not None and self.connection.socket:
+				self.send_queue.drain()
+
+	def shutdown(self):
+		self.disconnect()
+		if self.coordinator is not None:
+			# a worker that isn't connected (e.g. waits to reconnect) would
+			# keep running, die() leaves the reactor in any case
+			self.connection.execute_delayed(0, self.die)
+
+CounterBot.register_commands()
+
+class AsyncCounterBot(CounterBot):
+	"""
+		CounterBot on the asyncio engine (see aioirc.py). Replies are
+		buffered by the transport instead of blocking in socket.sendall().
+	"""
+	__slots__ = ()
+
+	reactor_class = AsyncReactor
+
+	def _send_raw(self, bytes):
+		self.connection.send_bytes(bytes)
+
+	def shutdown(self):
+		self.reactor.stop()
 
 def main(args):
 	import yaml
@@ -825,7 +3030,12 @@ def main(args):
 		config = {}
 		for key in ('host', 'nickname', 'password', 'default_period',
 		            'default_minint', 'default_maxint', 'default_result_limit',
-		            'gcinterval', 'max_message_length', 'state', 'home_channel'):
+		            'gcinterval', 'max_message_length', 'state', 'home_channel',
+		            'compact_counts', 'dedup_counts', 'message_cache_size',
+		            'collapse_replies', 'state_format', 'journal', 'journal_sync_interval',
+		            'checkpoint_interval', 'storage', 'database', 'handoff_socket',
+		            'engine', 'shards', 'send_queue', 'send_rate', 'send_rate_mod',
+		            'ingest_interval', 'tokenize_workers', 'query_threads'):
 			envkey = 'COUNTBOT_'+key.upper()
 			value = os.getenv(envkey)
 			if value:
@@ -838,59 +3048,176 @@ def main(args):
 				config[key] = value.split(',')
 	else:
 		with open(opts.config,'rb') as fp:
-			config = yaml.load(fp)
+			config = yaml.safe_load(fp)
 
 	server, port = config.get('host','irc.twitch.tv:6667').split(':', 1)
 	port = int(port)
 
 	statefile = config.get('state')
+	state_format = config.get('state_format', 'binary')
+	if state_format not in STATE_FORMATS:
+		raise ValueError('illegal state_format: %r' % state_format)
+	journal = parse_bool(config.get('journal', False))
+	if journal and (not statefile or state_format != 'binary'):
+		raise ValueError('journal needs a state file in the binary state_format')
+	journal_sync_interval = float(config.get('journal_sync_interval', 1))
+	checkpoint_interval = int(config.get('checkpoint_interval', 300))
+	if journal_sync_interval <= 0:
+		raise ValueError('illegal journal_sync_interval: %r' % journal_sync_interval)
+	if checkpoint_interval <= 0:
+		raise ValueError('illegal checkpoint_interval: %r' % checkpoint_interval)
+	storage = config.get('storage', 'memory')
+	if storage not in STORAGES:
+		raise ValueError('illegal storage: %r' % storage)
+	if storage == 'sqlite' and statefile:
+		raise ValueError('storage sqlite keeps the state in the database, state cannot be used with it')
+	database = config.get('database', 'counts.db')
+	handoff_socket = config.get('handoff_socket')
+	engine = config.get('engine', 'irc')
+	if engine not in ENGINES:
+		raise ValueError('illegal engine: %r' % engine)
+	if handoff_socket and storage == 'sqlite':
+		raise ValueError('handoff_socket cannot be used with storage sqlite')
+	shards = int(config.get('shards', 0))
+	if shards < 0:
+		raise ValueError('illegal shards: %r' % shards)
+	if shards and handoff_socket:
+		raise ValueError('handoff_socket cannot be used with shards')
+	send_queue = parse_bool(config.get('send_queue', False))
+	send_rate = int(config.get('send_rate', 20))
+	send_rate_mod = int(config.get('send_rate_mod', 100))
+	if send_rate <= 0:
+		raise ValueError('illegal send_rate: %r' % send_rate)
+	if send_rate_mod <= 0:
+		raise ValueError('illegal send_rate_mod: %r' % send_rate_mod)
+	ingest_interval = float(config.get('ingest_interval', 0))
+	if ingest_interval < 0:
+		raise ValueError('illegal ingest_interval: %r' % ingest_interval)
+	tokenize_workers = int(config.get('tokenize_workers', 0))
+	if tokenize_workers < 0:
+		raise ValueError('illegal tokenize_workers: %r' % tokenize_workers)
+	if tokenize_workers and not ingest_interval:
+		raise ValueError('tokenize_workers needs ingest_interval')
+	query_threads = int(config.get('query_threads', 0))
+	if query_threads < 0:
+		raise ValueError('illegal query_threads: %r' % query_threads)
+	if query_threads and storage != 'sqlite':
+		raise ValueError('query_threads needs storage: sqlite')
 	default_minint = config.get('default_minint')
 	default_maxint = config.get('default_maxint')
 	default_result_limit = config.get('default_result_limit')
 
-	bot = CounterBot(
-		config.get('home_channel'),
+	bot_class = AsyncCounterBot if engine == 'asyncio' else CounterBot
+	bot_args = (
 		int(config.get('default_period', 60 * 5)),
-		int(config.get('gcinterval', 60 * 10)),
+		int(config.get('gcinterval', 5)),
 		int(config.get('max_message_length', 512)),
 		int(default_minint) if default_minint is not None else None,
 		int(default_maxint) if default_maxint is not None else None,
 		int(default_result_limit) if default_result_limit is not None else None,
 		config.get('admins') or [],
 		config.get('ignore') or [],
-		config['nickname'],
-		config.get('channels') or [],
-		config.get('password'),
-		server,
-		port)
+		config['nickname'])
+	bot_kwargs = dict(
+		password=config.get('password'),
+		server=server,
+		port=port,
+		compact_counts=parse_bool(config.get('compact_counts', False)),
+		dedup_counts=parse_bool(config.get('dedup_counts', False)),
+		message_cache_size=int(config.get('message_cache_size', 4096)),
+		collapse_replies=parse_bool(config.get('collapse_replies', False)),
+		ingest_interval=ingest_interval)
+
+	def make_bot(home_channel, channels):
+		bot = bot_class(home_channel, *bot_args, channels, **bot_kwargs)
+		if send_queue:
+			bot.open_send_queue(send_rate, send_rate_mod)
+		return bot
+
+	bot = make_bot(config.get('home_channel'), config.get('channels') or [])
+
+	def run_bot(bot, statefile, database, setup=None):
+		shutdown = lambda signum, frame: bot.shutdown()
+		signal.signal(signal.SIGINT, shutdown)
+		signal.signal(signal.SIGTERM, shutdown)
+
+		def take_over():
+			if journal:
+				bot.open_journal(statefile, journal_sync_interval, checkpoint_interval, replay=False)
+			bot.serve_handoff(handoff_socket)
+
+		handed_over = handoff_socket and bot.receive_handoff(handoff_socket, take_over)
+
+		if statefile and not handed_over:
+			try:
+				with open(statefile, 'rb') as fp:
+					print('Loading state from %s...' % statefile)
+					if is_snapshot(fp.read(4)):
+						fp.seek(0)
+						bot.load_snapshot(fp)
+					else:
+						# version 1.0 YAML state
+						fp.seek(0)
+						bot.load(yaml.safe_load(fp))
+			except FileNotFoundError:
+				pass
+			fp = None
 
-	shutdown = lambda signum, frame: bot.disconnect()
-	signal.signal(signal.SIGINT, shutdown)
-	signal.signal(signal.SIGTERM, shutdown)
+			if journal:
+				bot.open_journal(statefile, journal_sync_interval, checkpoint_interval)
 
-	config = parser = opts = None
+		if storage == 'sqlite':
+			print('Opening database %s...' % database)
+			bot.open_database(database)
+
+		if handoff_socket and not handed_over:
+			bot.serve_handoff(handoff_socket)
+
+		if setup is not None:
+			setup()
+
+		if tokenize_workers:
+			bot.open_tokenizer_pool(tokenize_workers)
+
+		if query_threads:
+			bot.open_query_threads(query_threads)
 
-	if statefile:
 		try:
-			with open(statefile, 'r') as fp:
-				print('Loading state from %s...' % statefile)
-				state = yaml.load(fp)
-		except FileNotFoundError:
-			pass
-		else:
-			bot.load(state)
-			state = fp = None
+			print('Starting bot...')
+			bot.start()
+		finally:
+			bot.close_shards()
+			bot.close_handoff()
+			bot.close_query_threads()
+			bot.close_database()
+			# after a handoff the state belongs to the new process
+			if statefile and not bot.handed_off:
+				bot.close_journal()
+				print('\nDumping state to %s...' % statefile)
+				if state_format == 'yaml':
+					state = bot.dump()
+					write_file(statefile, lambda fp: yaml.dump(state, fp), 'w')
+				else:
+					write_file(statefile, bot.dump_snapshot)
+				if journal:
+					remove_segments(statefile + '.journal', bot.journal_sequence)
+			bot.close_tokenizer_pool()
+
+	if shards:
+		def run_worker(index, conn):
+			# the worker's channels are assigned by the coordinator
+			worker = make_bot(None, [])
+			run_bot(worker,
+				statefile and '%s.shard%d' % (statefile, index),
+				'%s.shard%d' % (database, index),
+				lambda: worker.serve_coordinator(conn))
+
+		# fork the workers before anything is loaded
+		bot.start_shards(shards, run_worker)
 
-	try:
-		print('Starting bot...')
-		bot.start()
-	finally:
-		if statefile:
-			print('\nDumping state to %s...' % statefile)
-			state = bot.dump()
-
-			with open(statefile, 'w') as fp:
-				yaml.dump(state, fp)
+	config = parser = opts = None
+
+	run_bot(bot, statefile, database)
 
 if __name__ == '__main__':
 	import sys
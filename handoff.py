@@ -0,0 +1,228 @@
+"""
+	Zero-downtime restart of WordCountBot by handing its state over to a new
+	process through a Unix domain socket.
+
+	The running process listens on the socket. A new process connects to it
+	before it connects to IRC and the old process sends it a snapshot of its
+	state (see snapshot.py, without index) followed by every change it makes
+	from then on as journal records (see journal.py). The new process loads
+	the snapshot, connects to IRC, replays the forwarded changes and sends
+	"done" once it has joined all channels. The old process stops
+	forwarding, closes its journal, sends the sequence number of its next
+	journal segment (a JSON integer, 0 without a journal) and exits. The new
+	process then takes over the socket for the next restart.
+
+		old -> new: snapshot, record, record, ..., sequence
+		new -> old: "done"
+
+	Messages that both processes see while the channels are joined twice are
+	counted twice, which doesn't matter because every word is only counted
+	once per user.
+"""
+
+import os
+import socket
+import select
+import threading
+import traceback
+
+from journal import encode_record, read_record
+
+# seconds between sending the forwarded changes
+FORWARD_INTERVAL = 0.05
+
+DONE = 'done'
+
+def connect(path):
+	"""
+		Connected socket to the process listening on path or None if there
+		is none.
+	"""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(path)
+	except (FileNotFoundError, ConnectionRefusedError):
+		sock.close()
+		return None
+	return sock
+
+class HandoffServer:
+	"""
+		Listens on path in a thread and calls accept(sock) in that thread for
+		the first process that connects. Then the socket file is removed, a
+		new HandoffServer has to be started for another handoff.
+	"""
+	__slots__ = 'path', 'accept', 'sock', 'thread'
+
+	def __init__(self, path, accept):
+		self.path = path
+		self.accept = accept
+		try:
+			# left behind by a process that didn't exit cleanly
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.bind(path)
+		self.sock.listen(1)
+		self.thread = threading.Thread(target=self.run, name='handoff-server')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		try:
+			conn, addr = self.sock.accept()
+		except OSError:
+			# closed
+			return
+		self.close()
+		self.accept(conn)
+
+	def close(self):
+		if self.sock is None:
+			return
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		self.sock.close()
+		self.sock = None
+		try:
+			os.remove(self.path)
+		except FileNotFoundError:
+			pass
+
+class HandoffSender:
+	"""
+		The old process' end. Records are appended by the reactor thread
+		and sent by run() in the thread of the connection.
+	"""
+	__slots__ = 'sock', 'lock', 'pending', 'wakeup'
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.lock = threading.Lock()
+		self.pending = []
+		self.wakeup = threading.Event()
+
+	def append(self, record):
+		data = encode_record(record)
+		with self.lock:
+			self.pending.append(data)
+		self.wakeup.set()
+
+	def send_pending(self, fp):
+		with self.lock:
+			pending, self.pending = self.pending, []
+		if pending:
+			fp.write(b''.join(pending))
+			fp.flush()
+
+	def run(self, write_state, finish):
+		"""
+			Send the state with write_state(fp) and then the appended records
+			until the new process is done. Then finish() is called, which has
+			to stop appending and return the journal sequence number for the
+			new process. Returns False if the new process went away before,
+			True once finish() was called.
+		"""
+		sock = self.sock
+		rfile = sock.makefile('rb')
+		wfile = sock.makefile('wb')
+		try:
+			try:
+				write_state(wfile)
+				wfile.flush()
+
+				while True:
+					self.wakeup.wait(FORWARD_INTERVAL)
+					self.wakeup.clear()
+					self.send_pending(wfile)
+
+					readable, _, _ = select.select([sock], [], [], 0)
+					if readable:
+						if read_record(rfile) != DONE:
+							raise EOFError('handoff aborted by the new process')
+						break
+			except (OSError, EOFError, ValueError):
+				traceback.print_exc()
+				return False
+
+			sequence = finish()
+			try:
+				self.send_pending(wfile)
+				wfile.write(encode_record(sequence))
+				wfile.flush()
+			except OSError:
+				# the new process has all it needs but the sequence
+				traceback.print_exc()
+			return True
+		finally:
+			rfile.close()
+			wfile.close()
+			sock.close()
+
+class HandoffReceiver:
+	"""
+		The new process' end. The state is read from fp, the forwarded
+		records by a thread started with start().
+	"""
+	__slots__ = 'sock', 'fp', 'wfile', 'replay', 'finish', 'thread', 'done_sent'
+
+	def __init__(self, sock, replay, finish):
+		"""
+			replay(record) is called for every forwarded record and then
+			finish(sequence), with sequence None if the old process went away
+			without sending it. Both in the thread started by start().
+		"""
+		self.sock = sock
+		self.replay = replay
+		self.finish = finish
+		self.fp = sock.makefile('rb')
+		self.wfile = sock.makefile('wb')
+		self.thread = None
+		self.done_sent = False
+
+	def start(self):
+		self.thread = threading.Thread(target=self.run, name='handoff-receiver')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		replay = self.replay
+		sequence = None
+		try:
+			while True:
+				record = read_record(self.fp)
+				if record is None:
+					break
+				if type(record) is int:
+					sequence = record
+					break
+				replay(record)
+		except Exception:
+			traceback.print_exc()
+		finally:
+			self.close()
+		self.finish(sequence)
+
+	def done(self):
+		"""
+			Tell the old process to stop, once all channels are joined.
+		"""
+		if self.done_sent:
+			return
+		self.done_sent = True
+		try:
+			self.wfile.write(encode_record(DONE))
+			self.wfile.flush()
+		except (OSError, ValueError):
+			traceback.print_exc()
+
+	def close(self):
+		for fp in self.fp, self.wfile:
+			try:
+				fp.close()
+			except OSError:
+				pass
+		self.sock.close()
@@ -0,0 +1,204 @@
+"""
+	Append-only write-ahead journal of WordCountBot.
+
+	Every change of the bot's state (counted words, changed channel settings,
+	joined and left channels) is appended to the journal as a record, so
+	that a crash loses at most the last sync interval of changes. The
+	journal is split into numbered segment files next to the state file:
+
+		STATEFILE.journal.1
+		STATEFILE.journal.2
+		...
+
+	Records are appended by the reactor thread into a buffer that a writer
+	thread writes and fsyncs in batches. A checkpoint starts a new segment
+	and writes a snapshot in a background thread. The snapshot stores the
+	number of the first segment it doesn't include, after which all older
+	segments are deleted. On startup the snapshot is loaded and the newer
+	segments are replayed.
+
+	A record is a JSON array framed by its length and CRC-32, little endian:
+
+		u32 length, u32 crc32, record (JSON)
+
+	Reading a segment stops at the first incomplete or corrupted record,
+	which is what a crash in the middle of a write leaves behind.
+"""
+
+import os
+import json
+import zlib
+import struct
+import threading
+import traceback
+
+FRAME = struct.Struct('<II')
+
+def segment_path(prefix, sequence):
+	return '%s.%d' % (prefix, sequence)
+
+def list_segments(prefix):
+	"""
+		Sorted list of (sequence, path) of the existing segments.
+	"""
+	dirname, basename = os.path.split(prefix)
+	basename += '.'
+	segments = []
+	try:
+		filenames = os.listdir(dirname or '.')
+	except FileNotFoundError:
+		return segments
+
+	for filename in filenames:
+		if filename.startswith(basename):
+			sequence = filename[len(basename):]
+			if sequence.isdigit():
+				segments.append((int(sequence), os.path.join(dirname, filename)))
+	segments.sort()
+	return segments
+
+def remove_segments(prefix, sequence):
+	"""
+		Delete all segments before sequence.
+	"""
+	for other, path in list_segments(prefix):
+		if other >= sequence:
+			break
+		try:
+			os.remove(path)
+		except FileNotFoundError:
+			pass
+
+def read_segment(path):
+	"""
+		Yields the records of a segment.
+	"""
+	with open(path, 'rb') as fp:
+		data = fp.read()
+
+	index = 0
+	end = len(data)
+	while index + FRAME.size <= end:
+		size, crc = FRAME.unpack_from(data, index)
+		index += FRAME.size
+		record = data[index:index + size]
+		if len(record) != size or zlib.crc32(record) != crc:
+			break
+		index += size
+		yield json.loads(record.decode('utf-8'))
+
+def encode_record(record):
+	data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+	return FRAME.pack(len(data), zlib.crc32(data)) + data
+
+def read_record(fp):
+	"""
+		Read the next record from a stream. Returns None at its end or at an
+		incomplete or corrupted record.
+	"""
+	header = fp.read(FRAME.size)
+	if len(header) != FRAME.size:
+		return None
+	size, crc = FRAME.unpack(header)
+	data = fp.read(size)
+	if len(data) != size or zlib.crc32(data) != crc:
+		return None
+	return json.loads(data.decode('utf-8'))
+
+class Journal:
+	__slots__ = ('prefix', 'sequence', 'sync_interval', 'lock', 'pending', 'wakeup',
+	             'closed', 'fp', 'writer', 'checkpoint_thread')
+
+	def __init__(self, prefix, sequence, sync_interval=1.0):
+		self.prefix = prefix
+		self.sequence = sequence
+		self.sync_interval = sync_interval
+		self.lock = threading.Lock()
+		# encoded records and segment numbers (start that segment) to be written
+		self.pending = []
+		self.wakeup = threading.Event()
+		self.closed = False
+		self.fp = open(segment_path(prefix, sequence), 'ab')
+		self.checkpoint_thread = None
+		self.writer = threading.Thread(target=self.run_writer, name='journal-writer')
+		self.writer.daemon = True
+		self.writer.start()
+
+	def append(self, record):
+		data = encode_record(record)
+		with self.lock:
+			self.pending.append(data)
+
+	def rotate(self):
+		"""
+			Start a new segment. All records appended before are in the
+			segments before the returned sequence number.
+		"""
+		with self.lock:
+			self.sequence += 1
+			self.pending.append(self.sequence)
+			return self.sequence
+
+	def run_writer(self):
+		while not self.closed:
+			self.wakeup.wait(self.sync_interval)
+			self.sync()
+
+	def sync(self):
+		with self.lock:
+			pending, self.pending = self.pending, []
+
+		if not pending:
+			return
+
+		fp = self.fp
+		for item in pending:
+			if type(item) is int:
+				fp.flush()
+				os.fsync(fp.fileno())
+				fp.close()
+				fp = self.fp = open(segment_path(self.prefix, item), 'ab')
+			else:
+				fp.write(item)
+		fp.flush()
+		os.fsync(fp.fileno())
+
+	def checkpoint(self, write):
+		"""
+			Start a new segment and call write(sequence) in a background
+			thread, which has to durably write a snapshot of the state as it
+			is now. The segments before sequence are deleted afterwards.
+			Returns False if the last checkpoint is still running.
+		"""
+		if self.checkpoint_thread is not None and self.checkpoint_thread.is_alive():
+			return False
+
+		sequence = self.rotate()
+		self.checkpoint_thread = threading.Thread(target=self.run_checkpoint, args=(write, sequence),
+			name='journal-checkpoint')
+		self.checkpoint_thread.daemon = True
+		self.checkpoint_thread.start()
+		return True
+
+	def run_checkpoint(self, write, sequence):
+		try:
+			write(sequence)
+		except Exception:
+			# keep the segments, they are still needed
+			traceback.print_exc()
+		else:
+			remove_segments(self.prefix, sequence)
+
+	def close(self):
+		"""
+			Write all pending records and wait for a running checkpoint.
+			Returns the sequence number after the last segment.
+		"""
+		self.closed = True
+		self.wakeup.set()
+		self.writer.join()
+		self.sync()
+		if self.checkpoint_thread is not None:
+			self.checkpoint_thread.join()
+		self.fp.close()
+		return self.sequence + 1
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import tempfile
+import subprocess
+
+from benchmark import summarize
+
+SERVER_NAME = 'tmi.localhost'
+
+class IRCServer:
+	"""
+		Just enough of a Twitch IRC server on localhost for one bot connection:
+		registration, CAP REQ, JOIN/PART with NAMES and MODE lines, PING/PONG
+		and PRIVMSG. The bot's replies to count commands are matched with the
+		commands to measure round-trip latencies.
+	"""
+
+	def __init__(self, opts):
+		self.opts = opts
+		self.rnd = random.Random(opts.seed)
+		self.users = ['user%d' % i for i in range(opts.users)]
+		self.channels = ['#loadchannel%d' % i for i in range(opts.channels)]
+		self.vocabulary = ['word%d' % i for i in range(opts.vocabulary)] + [str(i) for i in range(1, 5)]
+		self.writer = None
+		self.nick = None
+		self.joined = set()
+		self.all_joined = asyncio.Event()
+		# channel -> list of send times of unanswered commands
+		self.pending = dict((channel, []) for channel in self.channels)
+		self.latencies = []
+		self.replies = 0
+		self.errors = 0
+		self.messages_sent = 0
+		self.commands_sent = 0
+
+	def send(self, line):
+		self.writer.write(line.encode('utf-8') + b'\r\n')
+
+	async def handle_client(self, reader, writer):
+		if self.writer is not None:
+			writer.close()
+			return
+
+		self.writer = writer
+		while True:
+			line = await reader.readline()
+			if not line:
+				break
+			self.handle_line(line.decode('utf-8', 'replace').rstrip('\r\n'))
+		self.writer = None
+
+	def handle_line(self, line):
+		if line.startswith(':'):
+			line = line.split(' ', 1)[1]
+
+		if ' :' in line:
+			line, trailing = line.split(' :', 1)
+			args = line.split() + [trailing]
+		else:
+			args = line.split()
+
+		if not args:
+			return
+
+		command = args[0].upper()
+		args = args[1:]
+
+		if command == 'NICK':
+			self.nick = args[0]
+
+		elif command == 'USER':
+			self.send(':%s 001 %s :Welcome, GLHF!' % (SERVER_NAME, self.nick))
+			self.send(':%s 376 %s :>' % (SERVER_NAME, self.nick))
+
+		elif command == 'CAP':
+			if args[0].upper() == 'REQ':
+				self.send(':%s CAP * ACK :%s' % (SERVER_NAME, args[-1]))
+
+		elif command == 'PING':
+			self.send(':%s PONG %s :%s' % (SERVER_NAME, SERVER_NAME, args[-1]))
+
+		elif command == 'JOIN':
+			for channel in args[0].split(','):
+				self.join(channel)
+
+		elif command == 'PART':
+			for channel in args[0].split(','):
+				self.joined.discard(channel)
+				self.send(':%s!%s@%s.%s PART %s' % (self.nick, self.nick, self.nick, SERVER_NAME, channel))
+
+		elif command == 'PRIVMSG':
+			self.handle_privmsg(args[0], args[-1])
+
+	def join(self, channel):
+		nick = self.nick
+		self.send(':%s!%s@%s.%s JOIN %s' % (nick, nick, nick, SERVER_NAME, channel))
+		names = [nick] + self.rnd.sample(self.users, min(20, len(self.users)))
+		self.send(':%s.%s 353 %s = %s :%s' % (nick, SERVER_NAME, nick, channel, ' '.join(names)))
+		self.send(':%s.%s 366 %s %s :End of /NAMES list' % (nick, SERVER_NAME, nick, channel))
+		# Twitch sends the moderators as MODE lines
+		for mod in names[1:3]:
+			self.send(':jtv MODE %s +o %s' % (channel, mod))
+
+		self.joined.add(channel)
+		if all(channel in self.joined for channel in self.channels):
+			self.all_joined.set()
+
+	def handle_privmsg(self, channel, text):
+		if text.startswith('Word-counts within') or text.startswith('No words counted'):
+			self.replies += 1
+			pending = self.pending.get(channel)
+			if pending:
+				self.latencies.append(time.perf_counter() - pending.pop(0))
+		elif text.startswith('Error processing'):
+			self.errors += 1
+
+	def privmsg_line(self, user, channel, text):
+		return (':%s!%s@%s.%s PRIVMSG %s :%s\r\n' % (user, user, user, SERVER_NAME, channel, text)).encode('utf-8')
+
+	def chat_line(self):
+		rnd = self.rnd
+		words = ' '.join(rnd.choice(self.vocabulary) for _ in range(rnd.randint(1, 5)))
+		return self.privmsg_line(rnd.choice(self.users), rnd.choice(self.channels), words)
+
+	def command_line(self):
+		rnd = self.rnd
+		channel = rnd.choice(self.channels)
+		command = rnd.choice(['!count', '!count word1 word2 word3', '!countint', '!count1'])
+		self.pending[channel].append(time.perf_counter())
+		self.commands_sent += 1
+		return self.privmsg_line(rnd.choice(self.users), channel, command)
+
+	async def flood(self, duration):
+		opts = self.opts
+		tick = 0.01
+		start = time.perf_counter()
+		messages_due = 0.0
+		commands_due = 0.0
+		last = start
+		while last - start < duration:
+			if self.writer is None:
+				break
+			now = time.perf_counter()
+			messages_due += opts.messages_per_second * (now - last)
+			commands_due += opts.queries_per_second * (now - last)
+			last = now
+			lines = []
+			while messages_due >= 1:
+				lines.append(self.chat_line())
+				messages_due -= 1
+			while commands_due >= 1:
+				lines.append(self.command_line())
+				commands_due -= 1
+			self.messages_sent += len(lines)
+			self.writer.write(b''.join(lines))
+			# blocks when the bot doesn't keep up reading
+			await self.writer.drain()
+			await asyncio.sleep(tick)
+		return time.perf_counter() - start
+
+def write_config(fp, port, opts, channels):
+	import yaml
+
+	config = {
+		'host': '127.0.0.1:%d' % port,
+		'nickname': 'loadbot',
+		'home_channel': 'loadbot',
+		'channels': channels,
+		'gcinterval': 1,
+		'default_period': opts.period,
+		'ignore': ['jtv'],
+	}
+	for option in opts.bot_option:
+		key, value = option.split('=', 1)
+		config[key] = yaml.safe_load(value)
+	yaml.dump(config, fp)
+
+async def wait_for_bot(bot, event, timeout):
+	deadline = time.perf_counter() + timeout
+	while not event.is_set():
+		if bot.poll() is not None:
+			raise RuntimeError('bot exited with status %d' % bot.returncode)
+		if time.perf_counter() > deadline:
+			raise TimeoutError('bot did not join all channels in time')
+		await asyncio.sleep(0.05)
+
+async def run(opts):
+	server = IRCServer(opts)
+	irc_server = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+	port = irc_server.sockets[0].getsockname()[1]
+
+	countbot = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'countbot.py')
+	with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as fp:
+		write_config(fp, port, opts, server.channels)
+		config = fp.name
+
+	start = time.perf_counter()
+	bot = subprocess.Popen([sys.executable, countbot, '--config', config],
+		stdout=subprocess.DEVNULL, stderr=None if opts.verbose else subprocess.DEVNULL)
+	try:
+		await wait_for_bot(bot, server.all_joined, opts.timeout)
+		startup = time.perf_counter() - start
+
+		elapsed = await server.flood(opts.duration)
+
+		# give the bot time to answer outstanding commands
+		deadline = time.perf_counter() + opts.timeout
+		while any(server.pending.values()) and time.perf_counter() < deadline and server.writer is not None:
+			await asyncio.sleep(0.05)
+	finally:
+		bot.send_signal(signal.SIGTERM)
+		try:
+			bot.wait(opts.timeout)
+		except subprocess.TimeoutExpired:
+			bot.kill()
+		# let the connection handler see the EOF
+		await asyncio.sleep(0.1)
+		irc_server.close()
+		await irc_server.wait_closed()
+		os.unlink(config)
+
+	return {
+		'workload': {
+			'channels': opts.channels,
+			'users': opts.users,
+			'vocabulary': len(server.vocabulary),
+			'messages_per_second': opts.messages_per_second,
+			'queries_per_second': opts.queries_per_second,
+			'duration': opts.duration,
+			'period': opts.period,
+			'bot_options': opts.bot_option,
+		},
+		'startup_seconds': startup,
+		'flood_seconds': elapsed,
+		'messages_sent': server.messages_sent,
+		'messages_per_second': server.messages_sent / elapsed if elapsed else None,
+		'commands_sent': server.commands_sent,
+		'replies': server.replies,
+		'unanswered': sum(len(pending) for pending in server.pending.values()),
+		'errors': server.errors,
+		'round_trip': summarize(server.latencies),
+	}
+
+def main(args):
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description='Run countbot.py against a local IRC server that floods it with chat '
+		            'and measure command round-trip latencies. Prints JSON.')
+	parser.add_argument('--channels', type=int, default=100)
+	parser.add_argument('--users', type=int, default=5000)
+	parser.add_argument('--vocabulary', type=int, default=500)
+	parser.add_argument('--messages-per-second', type=int, default=2000, help='over all channels')
+	parser.add_argument('--queries-per-second', type=int, default=10, help='over all channels')
+	parser.add_argument('--duration', type=float, default=30, help='seconds')
+	parser.add_argument('--period', type=int, default=300)
+	parser.add_argument('--timeout', type=float, default=30)
+	parser.add_argument('--bot-option', action='append', default=[], metavar='KEY=VALUE',
+		help='additional bot configuration, e.g. compact_counts=true')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('-v', '--verbose', action='store_true', default=False, help="show the bot's stderr")
+	parser.add_argument('-o', '--output', help='write the JSON result to this file instead of stdout')
+	opts = parser.parse_args(args)
+
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	try:
+		result = loop.run_until_complete(run(opts))
+	finally:
+		loop.close()
+
+	if opts.output:
+		with open(opts.output, 'w') as fp:
+			json.dump(result, fp, indent=2, sort_keys=True)
+			fp.write('\n')
+	else:
+		json.dump(result, sys.stdout, indent=2, sort_keys=True)
+		sys.stdout.write('\n')
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,241 @@
+"""
+	Rate limited outbound message queue of WordCountBot.
+
+	Twitch drops messages of (and eventually throttles) accounts that send
+	more than 20 messages per 30 seconds, or 100 in channels where they are
+	moderator, and non-moderators can only send one message per second to
+	a channel. SendQueue keeps a token bucket for each of the two limits and
+	the time of the last message per channel. Queued messages are sent as
+	soon as the limits allow:
+
+	 * priority messages (admin replies in the home channel) first,
+	 * then one message per channel in turn, so that a busy channel doesn't
+	   delay the replies in all others.
+
+	A message can have a key (e.g. the command it answers). A newer message
+	with the same key in the same channel replaces the text of the queued
+	one, which keeps its place in the queue.
+
+	A message waits until there is a token for each of its lines. A message
+	with more lines than a bucket holds is sent in parts as the tokens come
+	back.
+"""
+
+from time import perf_counter
+from collections import OrderedDict, deque
+
+MIN_WAIT = 0.001
+
+class TokenBucket:
+	"""
+		count tokens, a token that is taken comes back period seconds later.
+		Unlike a bucket that refills continuously this never allows more
+		than count messages in any period, which is how Twitch counts.
+	"""
+	__slots__ = 'period', 'capacity', 'tokens', 'returns'
+
+	def __init__(self, count, period):
+		self.period = period
+		self.capacity = count
+		self.tokens = count
+		# times at which the taken tokens come back, in order
+		self.returns = deque()
+
+	def delay(self, now, count=1):
+		"""
+			Seconds until count tokens are available.
+		"""
+		returns = self.returns
+		while returns and returns[0] <= now:
+			returns.popleft()
+			self.tokens += 1
+		missing = min(count, self.capacity) - self.tokens
+		if missing <= 0:
+			return 0
+		return returns[missing - 1] - now
+
+	def take(self, count, now):
+		self.tokens -= count
+		at = now + self.period
+		self.returns.extend(at for _ in range(count))
+
+class QueuedMessage:
+	__slots__ = 'channel', 'lines', 'mod', 'key', 'stamp'
+
+	def __init__(self, channel, lines, mod, key, stamp):
+		self.channel = channel
+		self.lines = lines
+		self.mod = mod
+		self.key = key
+		self.stamp = stamp
+
+class SendQueue:
+	"""
+		send(lines) writes the lines of a message, schedule(delay, function)
+		calls function after delay seconds (the reactor's execute_delayed).
+	"""
+	__slots__ = ('send', 'schedule', 'clock', 'user_bucket', 'mod_bucket', 'channel_interval',
+	             'last_sent', 'priority', 'channels', 'keys', 'flush_at',
+	             'depth', 'max_depth', 'sent', 'merged', 'wait_total', 'wait_max')
+
+	def __init__(self, send, schedule, rate=20, mod_rate=100, period=30, channel_interval=1, clock=perf_counter):
+		self.send = send
+		self.schedule = schedule
+		self.clock = clock
+		self.user_bucket = TokenBucket(rate, period)
+		self.mod_bucket = TokenBucket(mod_rate, period)
+		# minimum seconds between messages to the same channel without mod
+		self.channel_interval = channel_interval
+		self.last_sent = {}
+		self.priority = deque()
+		# channel -> deque of QueuedMessage, in the order they are served
+		self.channels = OrderedDict()
+		# (channel, key) -> QueuedMessage
+		self.keys = {}
+		self.flush_at = None
+		# metrics
+		self.depth = 0
+		self.max_depth = 0
+		self.sent = 0
+		self.merged = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+
+	def __len__(self):
+		return self.depth
+
+	def enqueue(self, channel, lines, mod=False, key=None, priority=False):
+		if key is not None:
+			queued = self.keys.get((channel, key))
+			if queued is not None:
+				queued.lines = lines
+				self.merged += 1
+				return
+			key = (channel, key)
+
+		message = QueuedMessage(channel, lines, mod, key, self.clock())
+		if key is not None:
+			self.keys[key] = message
+
+		if priority:
+			self.priority.append(message)
+		else:
+			queue = self.channels.get(channel)
+			if queue is None:
+				queue = self.channels[channel] = deque()
+			queue.append(message)
+
+		self.depth += 1
+		if self.depth > self.max_depth:
+			self.max_depth = self.depth
+
+		self.flush()
+
+	def delay(self, message, now):
+		"""
+			Seconds until message may be sent.
+		"""
+		count = len(message.lines)
+		if message.mod:
+			return self.mod_bucket.delay(now, count)
+
+		delay = self.user_bucket.delay(now, count)
+		last_sent = self.last_sent.get(message.channel)
+		if last_sent is not None:
+			delay = max(delay, last_sent + self.channel_interval - now)
+		return delay
+
+	def flush(self):
+		"""
+			Send all messages the limits allow and schedule the next flush.
+		"""
+		now = self.clock()
+		wait = None
+
+		priority = self.priority
+		while priority:
+			delay = self.delay(priority[0], now)
+			if delay > 0:
+				wait = delay
+				break
+			if self.send_message(priority[0], now):
+				priority.popleft()
+
+		channels = self.channels
+		if wait is None and channels:
+			for channel in list(channels):
+				queue = channels[channel]
+				delay = self.delay(queue[0], now)
+				if delay > 0:
+					if wait is None or delay < wait:
+						wait = delay
+					continue
+
+				if self.send_message(queue[0], now):
+					queue.popleft()
+				# next turn after all other channels
+				del channels[channel]
+				if queue:
+					channels[channel] = queue
+					delay = self.delay(queue[0], now)
+					if wait is None or delay < wait:
+						wait = delay
+
+		if wait is not None:
+			# don't spin on rounding errors of the timer
+			if wait < MIN_WAIT:
+				wait = MIN_WAIT
+			due = now + wait
+			if self.flush_at is None or due < self.flush_at:
+				self.flush_at = due
+				self.schedule(wait, self.run_timer)
+
+	def run_timer(self):
+		self.flush_at = None
+		self.flush()
+
+	def send_message(self, message, now, limit=True):
+		"""
+			Send as many lines of message as there are tokens, or all of them
+			without limit. Returns whether the whole message was sent, if not
+			the rest stays queued.
+		"""
+		bucket = self.mod_bucket if message.mod else self.user_bucket
+		lines = message.lines
+		count = min(len(lines), bucket.tokens) if limit else len(lines)
+		bucket.take(count, now)
+		self.last_sent[message.channel] = now
+		if message.key is not None:
+			# the rest of a partly sent message isn't replaced anymore
+			del self.keys[message.key]
+			message.key = None
+		if count < len(lines):
+			message.lines = lines[count:]
+			self.send(lines[:count])
+			return False
+
+		self.depth -= 1
+		self.sent += 1
+		wait = now - message.stamp
+		self.wait_total += wait
+		if wait > self.wait_max:
+			self.wait_max = wait
+		self.send(lines)
+		return True
+
+	def drain(self):
+		"""
+			Send everything that is queued, ignoring the limits (on exit).
+		"""
+		now = self.clock()
+		while self.priority:
+			self.send_message(self.priority.popleft(), now, False)
+		for queue in self.channels.values():
+			while queue:
+				self.send_message(queue.popleft(), now, False)
+		self.channels.clear()
+
+	def stats(self):
+		return 'send queue: %d queued (max %d), %d sent, %d merged, wait %.0f ms avg, %.0f ms max' % (
+			self.depth, self.max_depth, self.sent, self.merged,
+			1000 * self.wait_total / self.sent if self.sent else 0, 1000 * self.wait_max)
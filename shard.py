@@ -0,0 +1,242 @@
+"""
+	Sharding of WordCountBot's channels over worker processes.
+
+	The coordinator process owns the home channel and the channel list and
+	assigns every other channel to one of N worker processes by consistent
+	hashing. Each worker has its own IRC connection and counts. Coordinator
+	and workers talk over multiprocessing pipes:
+
+		coordinator -> worker: ('join', channel), ('part', channel), ('shutdown',)
+		worker -> coordinator: ('parted', channel), ('load', {...})
+
+	When a worker dies only its channels are assigned to the remaining
+	workers, the other channels stay where they are.
+"""
+
+import sys
+import hashlib
+import threading
+import traceback
+import multiprocessing
+from bisect import bisect, insort
+
+# points per shard on the hash ring
+REPLICAS = 64
+
+def ring_hash(key):
+	return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+	"""
+		Consistent hashing of keys to nodes (integers). Removing a node only
+		moves the keys that were on it.
+	"""
+	__slots__ = 'replicas', 'points', 'nodes'
+
+	def __init__(self, nodes=(), replicas=REPLICAS):
+		self.replicas = replicas
+		# sorted (hash, node)
+		self.points = []
+		self.nodes = set()
+		for node in nodes:
+			self.add(node)
+
+	def __len__(self):
+		return len(self.nodes)
+
+	def add(self, node):
+		if node in self.nodes:
+			return
+		self.nodes.add(node)
+		for replica in range(self.replicas):
+			insort(self.points, (ring_hash('%d-%d' % (node, replica)), node))
+
+	def remove(self, node):
+		self.nodes.discard(node)
+		self.points = [point for point in self.points if point[1] != node]
+
+	def lookup(self, key):
+		points = self.points
+		if not points:
+			return None
+		index = bisect(points, (ring_hash(key), -1))
+		return points[index % len(points)][1]
+
+class Shard:
+	__slots__ = 'index', 'process', 'conn', 'channels', 'alive', 'load'
+
+	def __init__(self, index, process, conn):
+		self.index = index
+		self.process = process
+		self.conn = conn
+		self.channels = set()
+		self.alive = True
+		# last report of the worker
+		self.load = {}
+
+class ShardSet:
+	"""
+		The coordinator's side. run_worker(index, conn) is run in each
+		forked worker process. Messages of the workers are handled in a
+		thread per worker that holds lock, parted(channel) is called for a
+		channel a worker left on its own (!countleave).
+	"""
+	__slots__ = 'shards', 'ring', 'assignment', 'lock', 'parted', 'closed'
+
+	def __init__(self, count, run_worker, lock, parted):
+		self.lock = lock
+		self.parted = parted
+		self.closed = False
+		self.shards = []
+		# channel -> Shard
+		self.assignment = {}
+		# fork, so that run_worker doesn't have to be picklable
+		context = multiprocessing.get_context('fork')
+		for index in range(count):
+			conn, child_conn = context.Pipe()
+			process = context.Process(target=self.run_worker, args=(run_worker, index, child_conn),
+				name='shard-%d' % index)
+			process.start()
+			# only the worker may keep its end, or its EOF isn't seen
+			child_conn.close()
+			self.shards.append(Shard(index, process, conn))
+		self.ring = HashRing(range(count))
+
+		for shard in self.shards:
+			thread = threading.Thread(target=self.run_reader, args=(shard,), name='shard-reader-%d' % shard.index)
+			thread.daemon = True
+			thread.start()
+
+	def run_worker(self, run_worker, index, conn):
+		# the pipes to the other workers are inherited, the coordinator's
+		# EOF would not be seen while they are open
+		for shard in self.shards:
+			shard.conn.close()
+		run_worker(index, conn)
+
+	def send(self, shard, message):
+		try:
+			shard.conn.send(message)
+		except (OSError, ValueError):
+			# the reader thread handles the death
+			pass
+
+	def join(self, channel):
+		"""
+			Assign channel to a worker and make it join. Returns the Shard or
+			None if there is no worker left.
+		"""
+		shard = self.assignment.get(channel)
+		if shard is None:
+			index = self.ring.lookup(channel)
+			if index is None:
+				return None
+			shard = self.assignment[channel] = self.shards[index]
+			shard.channels.add(channel)
+		self.send(shard, ('join', channel))
+		return shard
+
+	def part(self, channel):
+		shard = self.assignment.pop(channel, None)
+		if shard is not None:
+			shard.channels.discard(channel)
+			self.send(shard, ('part', channel))
+		return shard
+
+	def run_reader(self, shard):
+		conn = shard.conn
+		while True:
+			try:
+				message = conn.recv()
+			except (EOFError, OSError):
+				break
+
+			with self.lock:
+				try:
+					self.handle(shard, message)
+				except Exception:
+					traceback.print_exc()
+
+		with self.lock:
+			self.remove(shard)
+
+	def handle(self, shard, message):
+		command = message[0]
+		if command == 'load':
+			shard.load = message[1]
+		elif command == 'parted':
+			channel = message[1]
+			if self.assignment.get(channel) is shard:
+				self.parted(channel)
+		else:
+			raise ValueError('illegal shard message: %r' % (message,))
+
+	def remove(self, shard):
+		"""
+			Assign the channels of a dead worker to the remaining workers.
+		"""
+		if not shard.alive or self.closed:
+			return
+		shard.alive = False
+		self.ring.remove(shard.index)
+		channels = sorted(shard.channels)
+		shard.channels.clear()
+		print('Shard %d died, moving %d channels to the other shards.' % (shard.index, len(channels)), file=sys.stderr)
+		for channel in channels:
+			del self.assignment[channel]
+			if self.join(channel) is None:
+				print('Error: no shard left for %s' % channel, file=sys.stderr)
+
+	def close(self, timeout=60):
+		"""
+			Stop the workers and wait for them to write their state.
+		"""
+		self.closed = True
+		for shard in self.shards:
+			self.send(shard, ('shutdown',))
+		for shard in self.shards:
+			process = shard.process
+			process.join(timeout)
+			if process.is_alive():
+				process.terminate()
+				process.join(5)
+				if process.is_alive():
+					process.kill()
+					process.join()
+
+class Coordinator:
+	"""
+		The worker's side. Messages of the coordinator are handled by a
+		thread that holds lock. When the coordinator goes away shutdown()
+		is called.
+	"""
+	__slots__ = 'conn', 'thread'
+
+	def __init__(self, conn, lock, handle, shutdown):
+		self.conn = conn
+		self.thread = threading.Thread(target=self.run, args=(lock, handle, shutdown), name='shard-coordinator')
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self, lock, handle, shutdown):
+		conn = self.conn
+		while True:
+			try:
+				message = conn.recv()
+			except (EOFError, OSError):
+				break
+
+			with lock:
+				try:
+					handle(message)
+				except Exception:
+					traceback.print_exc()
+
+		with lock:
+			shutdown()
+
+	def send(self, message):
+		try:
+			self.conn.send(message)
+		except (OSError, ValueError):
+			pass
@@ -0,0 +1,389 @@
+"""
+	Binary state snapshot format of WordCountBot.
+
+	A snapshot is the magic bytes and a version, followed by length prefixed,
+	zlib compressed segments. The first segment is the JSON encoded bot
+	settings, every following segment is one channel and a zero length ends
+	the channels. Since version 2 an index of the channel segments and a
+	trailer follow, so that single channels can be read without reading the
+	rest of the file (see SnapshotFile):
+
+		b'WCBS' u16 version
+		u32 length, settings (JSON)
+		u32 length, channel
+		...
+		u32 0
+		u32 length, index (JSON list of [channel, offset, length])
+		u64 offset of the index, b'WCBS'
+
+	A channel segment holds the channel's settings, its own string tables of
+	users and words and its rows as columns: one timestamp and row count per
+	bucket and the user and word ids of all rows. All integers are little
+	endian. Strings in a table are joined by NUL characters, which can't be
+	part of a nickname or a counted word. Since version 3 the minint, maxint
+	and result_limit settings that don't fit into 64 bits are written as
+	decimal strings after the channel name.
+"""
+
+import io
+import sys
+import json
+import mmap
+import zlib
+import struct
+from array import array
+
+MAGIC = b'WCBS'
+VERSION = 3
+VERSIONS = 1, 2, 3
+
+FILE_HEADER = struct.Struct('<4sH')
+TRAILER = struct.Struct('<Q4s')
+LENGTH = struct.Struct('<I')
+CHANNEL_HEADER = struct.Struct('<qBqBqBqIIII')
+
+# flags of the optional channel settings
+ABSENT = 0
+INT64 = 1
+# the value is the length of the decimal string
+DECIMAL = 2
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+BIG_ENDIAN = sys.byteorder == 'big'
+
+class SnapshotError(ValueError):
+	pass
+
+class ChannelSnapshot:
+	__slots__ = ('channel', 'period', 'minint', 'maxint', 'result_limit',
+	             'users', 'words', 'timestamps', 'sizes', 'user_ids', 'word_ids')
+
+	def __init__(self, channel, period, minint, maxint, result_limit,
+	             users, words, timestamps, sizes, user_ids, word_ids):
+		self.channel = channel
+		self.period = period
+		self.minint = minint
+		self.maxint = maxint
+		self.result_limit = result_limit
+		# string tables
+		self.users = users
+		self.words = words
+		# array('q') of bucket timestamps and array('I') of rows per bucket
+		self.timestamps = timestamps
+		self.sizes = sizes
+		# array('I') of ids into users and words, one per row
+		self.user_ids = user_ids
+		self.word_ids = word_ids
+
+	def __len__(self):
+		return len(self.user_ids)
+
+def optional(value):
+	"""
+		Flag, header value and decimal string of an optional integer setting.
+	"""
+	if value is None:
+		return ABSENT, 0, b''
+	if INT64_MIN <= value <= INT64_MAX:
+		return INT64, value, b''
+	decimal = str(value).encode('ascii')
+	return DECIMAL, len(decimal), decimal
+
+def read_optional(flag, value, data, index):
+	"""
+		Value of an optional integer setting and the index after it.
+	"""
+	if flag == ABSENT:
+		return None, index
+	if flag == INT64:
+		return value, index
+	if flag == DECIMAL:
+		end = index + value
+		if value <= 0 or end > len(data):
+			raise ValueError('truncated decimal')
+		return int(data[index:end].decode('ascii')), end
+	raise ValueError('illegal flag: %d' % flag)
+
+def join_table(symbols):
+	for symbol in symbols:
+		if '\0' in symbol:
+			raise SnapshotError('illegal string in snapshot: %r' % symbol)
+	return '\0'.join(symbols).encode('utf-8')
+
+def split_table(data, count):
+	if count == 0:
+		return []
+	symbols = data.decode('utf-8').split('\0')
+	if len(symbols) != count:
+		raise SnapshotError('corrupted string table')
+	return symbols
+
+def array_bytes(values):
+	if BIG_ENDIAN:
+		values = array(values.typecode, values)
+		values.byteswap()
+	return values.tobytes()
+
+def bytes_array(typecode, data):
+	values = array(typecode)
+	values.frombytes(data)
+	if BIG_ENDIAN:
+		values.byteswap()
+	return values
+
+def encode_channel(snapshot):
+	channel = snapshot.channel.encode('utf-8')
+	users = join_table(snapshot.users)
+	words = join_table(snapshot.words)
+	has_minint, minint, minint_decimal = optional(snapshot.minint)
+	has_maxint, maxint, maxint_decimal = optional(snapshot.maxint)
+	has_result_limit, result_limit, result_limit_decimal = optional(snapshot.result_limit)
+	header = CHANNEL_HEADER.pack(
+		snapshot.period,
+		has_minint, minint, has_maxint, maxint, has_result_limit, result_limit,
+		len(channel), len(snapshot.users), len(snapshot.words), len(snapshot.timestamps))
+	return b''.join((
+		header,
+		channel,
+		minint_decimal, maxint_decimal, result_limit_decimal,
+		LENGTH.pack(len(users)), users,
+		LENGTH.pack(len(words)), words,
+		array_bytes(snapshot.timestamps),
+		array_bytes(snapshot.sizes),
+		array_bytes(snapshot.user_ids),
+		array_bytes(snapshot.word_ids),
+	))
+
+def decode_channel(data):
+	try:
+		(period, has_minint, minint, has_maxint, maxint, has_result_limit, result_limit,
+		 channel_len, user_count, word_count, bucket_count) = CHANNEL_HEADER.unpack_from(data)
+		index = CHANNEL_HEADER.size
+		channel = data[index:index + channel_len].decode('utf-8')
+		index += channel_len
+
+		minint, index = read_optional(has_minint, minint, data, index)
+		maxint, index = read_optional(has_maxint, maxint, data, index)
+		result_limit, index = read_optional(has_result_limit, result_limit, data, index)
+
+		tables = []
+		for count in user_count, word_count:
+			size, = LENGTH.unpack_from(data, index)
+			index += LENGTH.size
+			tables.append(split_table(data[index:index + size], count))
+			index += size
+		users, words = tables
+
+		timestamps = bytes_array('q', data[index:index + 8 * bucket_count])
+		index += 8 * bucket_count
+		sizes = bytes_array('I', data[index:index + 4 * bucket_count])
+		index += 4 * bucket_count
+		row_count = sum(sizes)
+		user_ids = bytes_array('I', data[index:index + 4 * row_count])
+		index += 4 * row_count
+		word_ids = bytes_array('I', data[index:index + 4 * row_count])
+		index += 4 * row_count
+	except (struct.error, UnicodeDecodeError, ValueError) as exc:
+		raise SnapshotError('corrupted channel segment: %s' % exc)
+
+	if index != len(data) or len(word_ids) != row_count or len(timestamps) != bucket_count:
+		raise SnapshotError('corrupted channel segment')
+
+	if (user_ids and max(user_ids) >= user_count) or (word_ids and max(word_ids) >= word_count):
+		raise SnapshotError('illegal string id in channel %s' % channel)
+
+	return ChannelSnapshot(channel, period, minint, maxint, result_limit,
+		users, words, timestamps, sizes, user_ids, word_ids)
+
+def write_segment(fp, data, level):
+	return write_raw_segment(fp, zlib.compress(data, level))
+
+def write_raw_segment(fp, data):
+	fp.write(LENGTH.pack(len(data)))
+	fp.write(data)
+	return LENGTH.size + len(data)
+
+def decompress(data):
+	try:
+		return zlib.decompress(data)
+	except zlib.error as exc:
+		raise SnapshotError('corrupted snapshot: %s' % exc)
+
+def read_segment(fp):
+	data = fp.read(LENGTH.size)
+	if len(data) != LENGTH.size:
+		raise SnapshotError('truncated snapshot')
+	size, = LENGTH.unpack(data)
+	if size == 0:
+		return None
+	data = fp.read(size)
+	if len(data) != size:
+		raise SnapshotError('truncated snapshot')
+	return decompress(data)
+
+def write_snapshot(fp, settings, channels, raw_channels=(), level=1, index=True):
+	"""
+		Write the settings dict (JSON serializable) and the ChannelSnapshot
+		objects of the channels iterable to the binary file object fp.
+		raw_channels are (channel, segment) pairs of compressed segments as
+		returned by SnapshotFile.raw(), which are copied as they are.
+		Without index the snapshot ends after the channels and can only be
+		read with read_snapshot(), which is all a stream needs.
+	"""
+	fp.write(FILE_HEADER.pack(MAGIC, VERSION))
+	offset = FILE_HEADER.size
+	offset += write_segment(fp, json.dumps(settings).encode('utf-8'), level)
+
+	segments = []
+	for snapshot in channels:
+		size = write_segment(fp, encode_channel(snapshot), level)
+		segments.append((snapshot.channel, offset, size))
+		offset += size
+
+	for channel, data in raw_channels:
+		size = write_raw_segment(fp, data)
+		segments.append((channel, offset, size))
+		offset += size
+
+	fp.write(LENGTH.pack(0))
+	if not index:
+		return
+	offset += LENGTH.size
+	write_segment(fp, json.dumps(segments).encode('utf-8'), level)
+	fp.write(TRAILER.pack(offset, MAGIC))
+
+def is_snapshot(data):
+	return data[:len(MAGIC)] == MAGIC
+
+def read_snapshot(fp):
+	"""
+		Returns the settings dict and an iterator over the ChannelSnapshot
+		objects, which reads the channels one at a time from fp.
+	"""
+	data = fp.read(FILE_HEADER.size)
+	if len(data) != FILE_HEADER.size or not is_snapshot(data):
+		raise SnapshotError('not a snapshot')
+
+	magic, version = FILE_HEADER.unpack(data)
+	if version not in VERSIONS:
+		raise SnapshotError('unsupported snapshot version: %d' % version)
+
+	data = read_segment(fp)
+	if data is None:
+		raise SnapshotError('snapshot without settings')
+	settings = json.loads(data.decode('utf-8'))
+
+	def channels():
+		while True:
+			data = read_segment(fp)
+			if data is None:
+				break
+			yield decode_channel(data)
+
+	return settings, channels()
+
+def open_snapshot(fp):
+	"""
+		SnapshotFile of fp or None if the snapshot has no index (version 1),
+		then it has to be read with read_snapshot().
+	"""
+	data = fp.read(FILE_HEADER.size)
+	fp.seek(0)
+	if len(data) == FILE_HEADER.size and is_snapshot(data) and FILE_HEADER.unpack(data)[1] < 2:
+		return None
+	return SnapshotFile(fp)
+
+class SnapshotFile:
+	"""
+		Random access to the channels of a snapshot through its index. Files
+		are memory mapped, so only the segments of channels that are read
+		are paged in. Channels are removed from the SnapshotFile when they
+		are read, when none are left the file is closed.
+	"""
+	__slots__ = 'buffer', 'settings', 'index'
+
+	def __init__(self, fp):
+		try:
+			fileno = fp.fileno()
+		except (AttributeError, io.UnsupportedOperation):
+			buffer = fp.read()
+		else:
+			buffer = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+		try:
+			if len(buffer) < FILE_HEADER.size + TRAILER.size or not is_snapshot(buffer[:len(MAGIC)]):
+				raise SnapshotError('not a snapshot')
+
+			magic, version = FILE_HEADER.unpack_from(buffer)
+			if version not in VERSIONS:
+				raise SnapshotError('unsupported snapshot version: %d' % version)
+
+			offset, magic = TRAILER.unpack_from(buffer, len(buffer) - TRAILER.size)
+			if version < 2 or magic != MAGIC:
+				raise SnapshotError('snapshot has no index')
+
+			self.buffer = buffer
+			self.settings = json.loads(self.segment(FILE_HEADER.size).decode('utf-8'))
+			self.index = dict((channel, (offset, size))
+				for channel, offset, size in json.loads(self.segment(offset).decode('utf-8')))
+			if not self.index:
+				self.close()
+		except Exception:
+			if type(buffer) is mmap.mmap:
+				buffer.close()
+			raise
+
+	def segment(self, offset):
+		buffer = self.buffer
+		try:
+			size, = LENGTH.unpack_from(buffer, offset)
+		except struct.error:
+			raise SnapshotError('truncated snapshot')
+		offset += LENGTH.size
+		data = buffer[offset:offset + size]
+		if len(data) != size:
+			raise SnapshotError('truncated snapshot')
+		return decompress(data)
+
+	def __len__(self):
+		return len(self.index)
+
+	def __contains__(self, channel):
+		return channel in self.index
+
+	def channels(self):
+		"""
+			The remaining channels, smallest first.
+		"""
+		return sorted(self.index, key=lambda channel: self.index[channel][1])
+
+	def raw(self, channel):
+		"""
+			The compressed segment of the channel, for write_snapshot().
+		"""
+		offset, size = self.index[channel]
+		return self.buffer[offset + LENGTH.size:offset + size]
+
+	def read(self, channel):
+		"""
+			The ChannelSnapshot of the channel, which stays in the file.
+		"""
+		offset, size = self.index[channel]
+		return decode_channel(self.segment(offset))
+
+	def pop(self, channel):
+		snapshot = self.read(channel)
+		self.discard(channel)
+		return snapshot
+
+	def discard(self, channel):
+		if self.index.pop(channel, None) is not None and not self.index:
+			self.close()
+
+	def close(self):
+		self.index = {}
+		if type(self.buffer) is mmap.mmap:
+			self.buffer.close()
+		self.buffer = b''
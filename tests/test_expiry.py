@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irc.client import Event, NickMask
+
+from benchmark import BenchmarkBot
+from countbot import ExpiryWheel
+
+def make_bot():
+	bot = BenchmarkBot(None, 300, 5, 512, None, None, 10, [], [], 'testbot', [])
+	bot.timers = []
+	bot.connection.execute_delayed = lambda delay, function, arguments=(): bot.timers.append((function, arguments))
+	bot.connection.part = lambda channel, message='': None
+	return bot
+
+class ExpiryWheelTest(unittest.TestCase):
+	def test_cancel_last(self):
+		wheel = ExpiryWheel(60)
+		wheel.schedule('#a', 1000)
+		wheel.cancel('#a')
+		self.assertIsNone(wheel.current)
+		self.assertEqual(wheel.pop_due(900), [])
+		self.assertIsNone(wheel.next_due())
+
+	def test_next_due(self):
+		wheel = ExpiryWheel(5, size=4)
+		self.assertEqual(wheel.schedule('#a', 1000), 1000)
+		self.assertEqual(wheel.schedule('#b', 1501), 1505)
+		self.assertEqual(wheel.next_due(), 1000)
+		self.assertEqual(wheel.pop_due(999), [])
+		self.assertEqual(wheel.pop_due(1000), ['#a'])
+		self.assertEqual(wheel.next_due(), 1505)
+		self.assertEqual(wheel.pop_due(1505), ['#b'])
+		self.assertIsNone(wheel.next_due())
+
+class GcAfterPartTest(unittest.TestCase):
+	def test_part_then_gc(self):
+		bot = make_bot()
+		bot.set_gcinterval(60)
+		bot.join_fake('#a')
+		bot.on_pubmsg(None, Event('pubmsg', NickMask('user!user@tmi.twitch.tv'), '#a', ['hello world']))
+		self.assertIn('#a', bot.expiry)
+
+		bot.do_part('#a')
+		self.assertNotIn('#a', bot.channel_data)
+
+		# the run_gc scheduled for the parted channel
+		self.assertTrue(bot.timers)
+		bot.clock += 1
+		for function, arguments in bot.timers:
+			function(*arguments)
+		self.assertEqual(len(bot.expiry), 0)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,62 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sendqueue import SendQueue
+
+class SimulatedQueue:
+	"""
+		A SendQueue on a simulated clock, whose timers are run by run().
+	"""
+	def __init__(self, **kwargs):
+		self.now = 0.0
+		self.timers = []
+		self.sent = []
+		self.queue = SendQueue(self.send, self.schedule, clock=lambda: self.now, **kwargs)
+
+	def send(self, lines):
+		self.sent.extend((self.now, line) for line in lines)
+
+	def schedule(self, delay, function):
+		self.timers.append((self.now + delay, function))
+
+	def run(self):
+		while self.timers:
+			self.timers.sort(key=lambda timer: timer[0])
+			self.now, function = self.timers.pop(0)
+			function()
+
+	def max_per_period(self, period=30):
+		times = [at for at, line in self.sent]
+		return max(sum(1 for other in times if at <= other < at + period) for at in times)
+
+class SendQueueTest(unittest.TestCase):
+	def test_multi_line_replies(self):
+		sim = SimulatedQueue(rate=20, channel_interval=0)
+		for index in range(40):
+			sim.queue.enqueue('#channel%d' % index, ['a', 'b', 'c'])
+		sim.run()
+		self.assertEqual(len(sim.sent), 120)
+		self.assertLessEqual(sim.max_per_period(), 20)
+
+	def test_reply_longer_than_bucket(self):
+		sim = SimulatedQueue(rate=20, channel_interval=0)
+		lines = ['line %d' % index for index in range(50)]
+		sim.queue.enqueue('#channel', lines)
+		sim.queue.enqueue('#channel', ['after'])
+		sim.run()
+		self.assertEqual([line for at, line in sim.sent], lines + ['after'])
+		self.assertLessEqual(sim.max_per_period(), 20)
+		self.assertEqual(len(sim.queue), 0)
+
+	def test_mod_reply_longer_than_bucket(self):
+		sim = SimulatedQueue(rate=20, mod_rate=30, channel_interval=0)
+		sim.queue.enqueue('#channel', ['line %d' % index for index in range(100)], mod=True)
+		sim.run()
+		self.assertEqual(len(sim.sent), 100)
+		self.assertLessEqual(sim.max_per_period(), 30)
+
+if __name__ == '__main__':
+	unittest.main()